@@ -1,20 +1,55 @@
 import streamlit as st
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import requests
 from datetime import datetime
 import os
 from typing import Dict, Any
 import json
 import pickle
+import random
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import sys
+import csv
+import gzip
+import queue
+import atexit
+import uuid
+import threading
+import time
+import cProfile
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    # Conversation logs fall back to gzipped CSV
+    pa = None
+
+# Parsed config file, re-read only when its modification time changes
+CONFIG_CACHE = {"mtime": None, "config": {}}
+
 def load_config():
     """Load configuration from file."""
     config_file = Path("app_config.json")
     if config_file.exists():
         try:
-            with open(config_file, 'r') as f:
-                return json.load(f)
+            mtime = config_file.stat().st_mtime
+            if CONFIG_CACHE["mtime"] != mtime:
+                with open(config_file, 'r') as f:
+                    CONFIG_CACHE["config"] = json.load(f)
+                CONFIG_CACHE["mtime"] = mtime
+            return dict(CONFIG_CACHE["config"])
         except:
             pass
     return {}
@@ -24,9 +59,626 @@ def save_config(config):
     try:
         with open("app_config.json", 'w') as f:
             json.dump(config, f)
-        return True
     except:
         return False
+    
+    # Tell the other workers to reload their sessions' settings
+    try:
+        get_shared_store().incr("config_version")
+    except sqlite3.Error:
+        pass
+    return True
+
+# Settings the response pipeline reads, copied from the session for work off the script thread
+PIPELINE_SETTINGS = [
+    "fast_path_enabled", "response_templates", "faq_enabled", "faq_ttl", "knowledge_base",
+    "generation_policy", "prompt_cache_mode", "rate_limit_per_minute", "background_rate_share",
+    "response_cache_ttl", "tiered_routing", "tier_complexity_threshold", "model_tiers",
+    "health_probe_interval", "conversation_log_enabled", "conversation_log_dir"
+]
+
+setting_overrides = threading.local()
+
+def get_setting(key: str, default=None):
+    """Read a setting from the thread's snapshot or the session, falling back to the saved config."""
+    overrides = getattr(setting_overrides, "values", None)
+    if overrides is not None and key in overrides:
+        return overrides[key]
+    
+    # Background threads and the CLI have no session; don't make Streamlit warn about it
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        try:
+            if key in st.session_state:
+                return st.session_state[key]
+        except Exception:
+            pass
+    return load_config().get(key, default)
+
+def snapshot_settings() -> Dict[str, Any]:
+    """Copy the session's pipeline settings so a background job answers with them."""
+    return {key: st.session_state[key] for key in PIPELINE_SETTINGS if key in st.session_state}
+
+@contextmanager
+def use_settings(settings: Dict[str, Any]):
+    """Make get_setting on this thread read from a settings snapshot."""
+    previous = getattr(setting_overrides, "values", None)
+    setting_overrides.values = settings
+    try:
+        yield
+    finally:
+        setting_overrides.values = previous
+
+class SharedStore(ABC):
+    """Key-value state shared by every worker process on a host.
+    
+    Backends are registered in STORE_BACKENDS and picked with the
+    XENON_SHARED_STATE environment variable ("sqlite:<path>" or "memory").
+    Values must be JSON-serializable.
+    """
+    
+    @abstractmethod
+    def get(self, key: str, default=None):
+        """Return the value stored under key, or default if missing or expired."""
+    
+    @abstractmethod
+    def set(self, key: str, value, ttl: float = None):
+        """Store a value, expiring after ttl seconds if given."""
+    
+    @abstractmethod
+    def incr(self, key: str, amount: float = 1) -> float:
+        """Atomically add to a numeric value and return the result."""
+    
+    @abstractmethod
+    def scan(self, prefix: str) -> Dict[str, Any]:
+        """Return all live entries whose key starts with prefix."""
+    
+    @abstractmethod
+    def take_token(self, bucket: str, rate: float, capacity: float) -> bool:
+        """Take one token from a token bucket refilled at `rate` tokens per second."""
+    
+    @abstractmethod
+    def purge_expired(self) -> int:
+        """Delete expired entries and return how many were removed."""
+
+# How often a store deletes expired entries; reads already skip them in between
+STORE_SWEEP_SECONDS = 300
+
+def refill_bucket(state, rate: float, capacity: float, now: float):
+    """Refill a token bucket state and try to take one token from it."""
+    if state is None:
+        state = {"tokens": capacity, "updated": now}
+    
+    tokens = min(capacity, state["tokens"] + (now - state["updated"]) * rate)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    return allowed, {"tokens": tokens, "updated": now}
+
+class MemoryStore(SharedStore):
+    """In-process stand-in for a shared store (single worker, tests)."""
+    
+    def __init__(self, path: str = ""):
+        self.data = {}
+        self.lock = threading.Lock()
+        self.next_sweep = time.time() + STORE_SWEEP_SECONDS
+    
+    def _get_live(self, key: str):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            del self.data[key]
+            return None
+        return entry
+    
+    def get(self, key: str, default=None):
+        with self.lock:
+            entry = self._get_live(key)
+            return entry[0] if entry else default
+    
+    def set(self, key: str, value, ttl: float = None):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl if ttl else None)
+        if time.time() >= self.next_sweep:
+            self.purge_expired()
+    
+    def incr(self, key: str, amount: float = 1) -> float:
+        with self.lock:
+            entry = self._get_live(key)
+            value = (entry[0] if entry else 0) + amount
+            self.data[key] = (value, entry[1] if entry else None)
+            return value
+    
+    def scan(self, prefix: str) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                key: entry[0]
+                for key in list(self.data)
+                if key.startswith(prefix) and (entry := self._get_live(key))
+            }
+    
+    def take_token(self, bucket: str, rate: float, capacity: float) -> bool:
+        with self.lock:
+            entry = self._get_live(bucket)
+            allowed, state = refill_bucket(entry[0] if entry else None, rate, capacity, time.time())
+            self.data[bucket] = (state, None)
+            return allowed
+    
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self.lock:
+            self.next_sweep = now + STORE_SWEEP_SECONDS
+            expired = [key for key, entry in self.data.items() if entry[1] is not None and entry[1] < now]
+            for key in expired:
+                del self.data[key]
+            return len(expired)
+
+class SQLiteStore(SharedStore):
+    """Shared store in a SQLite database in WAL mode, safe across processes on one host."""
+    
+    def __init__(self, path: str = "xenon_state.db"):
+        self.path = path
+        self.local = threading.local()
+        self.next_sweep = time.time() + STORE_SWEEP_SECONDS
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)")
+    
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        # IMMEDIATE takes the write lock up front so read-modify-write is atomic across workers
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    def _read(self, conn, key: str):
+        row = conn.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None, None
+        return json.loads(row[0]), row[1]
+    
+    def _write(self, conn, key: str, value, expires):
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires)
+        )
+    
+    def get(self, key: str, default=None):
+        value, _ = self._read(self._connect(), key)
+        return default if value is None else value
+    
+    def set(self, key: str, value, ttl: float = None):
+        with self._transaction() as conn:
+            self._write(conn, key, value, time.time() + ttl if ttl else None)
+        # Each worker sweeps now and then, so expired responses, jobs and FAQ versions don't pile up
+        if time.time() >= self.next_sweep:
+            self.purge_expired()
+    
+    def incr(self, key: str, amount: float = 1) -> float:
+        with self._transaction() as conn:
+            value, expires = self._read(conn, key)
+            value = (value or 0) + amount
+            self._write(conn, key, value, expires)
+            return value
+    
+    def scan(self, prefix: str) -> Dict[str, Any]:
+        rows = self._connect().execute(
+            "SELECT key, value FROM kv WHERE substr(key, 1, ?) = ? AND (expires IS NULL OR expires >= ?)",
+            (len(prefix), prefix, time.time())
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+    
+    def take_token(self, bucket: str, rate: float, capacity: float) -> bool:
+        with self._transaction() as conn:
+            state, _ = self._read(conn, bucket)
+            allowed, state = refill_bucket(state, rate, capacity, time.time())
+            self._write(conn, bucket, state, None)
+            return allowed
+    
+    def purge_expired(self) -> int:
+        self.next_sweep = time.time() + STORE_SWEEP_SECONDS
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM kv WHERE expires < ?", (time.time(),)).rowcount
+
+# Shared-state backends by name; add a Redis-backed SharedStore here to scale past one host
+STORE_BACKENDS = {
+    "memory": MemoryStore,
+    "sqlite": SQLiteStore
+}
+
+shared_store = None
+shared_store_lock = threading.Lock()
+
+def get_shared_store() -> SharedStore:
+    """Return the process-wide shared store, created from XENON_SHARED_STATE on first use."""
+    global shared_store
+    with shared_store_lock:
+        if shared_store is None:
+            backend, _, path = os.environ.get("XENON_SHARED_STATE", "sqlite:xenon_state.db").partition(":")
+            try:
+                shared_store = STORE_BACKENDS[backend](path) if path else STORE_BACKENDS[backend]()
+            except (KeyError, sqlite3.Error, OSError):
+                # Fall back to per-process state rather than failing every request
+                shared_store = MemoryStore()
+        return shared_store
+
+def record_metric(name: str, amount: float = 1):
+    """Add to a metric counter shared by all workers."""
+    try:
+        get_shared_store().incr(f"metric:{name}", amount)
+    except sqlite3.Error:
+        pass
+
+def get_shared_metrics() -> Dict[str, Any]:
+    """Return all shared metric counters."""
+    return {key[len("metric:"):]: value for key, value in get_shared_store().scan("metric:").items()}
+
+def get_config_version() -> int:
+    """Return the config version, bumped by every save_config from any worker."""
+    try:
+        return int(get_shared_store().get("config_version", 0))
+    except sqlite3.Error:
+        return 0
+
+def take_upstream_token(provider: str, background: bool = False) -> bool:
+    """Take a token from the provider's host-wide rate limit bucket.
+    
+    Background work (FAQ warm-up and refreshes) must first get a token from its
+    own smaller bucket, so it can use at most `background_rate_share` of the limit
+    and live users always keep the rest.
+    """
+    per_minute = get_setting("rate_limit_per_minute", 60)
+    if not per_minute:
+        return True
+    
+    try:
+        store = get_shared_store()
+        if background:
+            background_per_minute = max(1.0, per_minute * get_setting("background_rate_share", 0.25))
+            if not store.take_token(f"bucket:background:{provider}", background_per_minute / 60.0, background_per_minute):
+                return False
+        return store.take_token(f"bucket:{provider}", per_minute / 60.0, per_minute)
+    except sqlite3.Error:
+        # Don't block users because the store is unavailable
+        return True
+
+def response_cache_key(messages: list, model: str) -> str:
+    """Build a response cache key from the exact messages and model."""
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True)
+    return "response:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_response(cache_key: str):
+    """Return a response another worker already generated for these messages, or None."""
+    try:
+        return get_shared_store().get(cache_key)
+    except sqlite3.Error:
+        return None
+
+def store_cached_response(cache_key: str, response: str):
+    """Share a generated response with every worker for the configured TTL."""
+    ttl = get_setting("response_cache_ttl", 3600)
+    if not ttl:
+        return
+    try:
+        get_shared_store().set(cache_key, response, ttl=ttl)
+    except sqlite3.Error:
+        pass
+
+# Conversation log, written in batches by a background thread so requests never wait on disk
+CONVERSATION_LOG_FIELDS = [
+    "timestamp", "session_id", "query", "normalized_query", "response", "source",
+    "provider", "model", "latency_ms", "prompt_tokens", "completion_tokens",
+    "cached_tokens", "verdict"
+]
+CONVERSATION_LOG_BATCH_SIZE = 500
+CONVERSATION_LOG_FLUSH_SECONDS = 30
+
+conversation_log_queue = queue.Queue(maxsize=50000)
+CONVERSATION_LOG_STATS = {"written": 0, "dropped": 0, "files": 0, "last_error": ""}
+conversation_log_lock = threading.Lock()
+conversation_logger_thread = None
+
+def log_conversation_turn(record: Dict[str, Any]):
+    """Queue a conversation turn for the background logger without blocking."""
+    if not get_setting("conversation_log_enabled", True):
+        return
+    
+    start_conversation_logger()
+    try:
+        conversation_log_queue.put_nowait(record)
+    except queue.Full:
+        with conversation_log_lock:
+            CONVERSATION_LOG_STATS["dropped"] += 1
+
+def write_conversation_batch(records: list, log_dir: str):
+    """Write a batch of turns to a date-partitioned Parquet file, or gzipped CSV without pyarrow."""
+    by_date = {}
+    for record in records:
+        by_date.setdefault(record["timestamp"][:10], []).append(record)
+    
+    for date, date_records in by_date.items():
+        partition = Path(log_dir) / f"date={date}"
+        partition.mkdir(parents=True, exist_ok=True)
+        name = f"part-{datetime.now().strftime('%H%M%S%f')}-{os.getpid()}"
+        
+        if pa is not None:
+            columns = {field: [record.get(field) for record in date_records] for field in CONVERSATION_LOG_FIELDS}
+            pq.write_table(pa.table(columns), partition / f"{name}.parquet", compression="zstd")
+        else:
+            with gzip.open(partition / f"{name}.csv.gz", "wt", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=CONVERSATION_LOG_FIELDS, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(date_records)
+        
+        with conversation_log_lock:
+            CONVERSATION_LOG_STATS["files"] += 1
+
+def flush_conversation_log(max_records: int = None) -> int:
+    """Write out queued turns now; returns the number written."""
+    records = []
+    while max_records is None or len(records) < max_records:
+        try:
+            records.append(conversation_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    
+    if records:
+        try:
+            write_conversation_batch(records, get_setting("conversation_log_dir", "logs/conversations"))
+            with conversation_log_lock:
+                CONVERSATION_LOG_STATS["written"] += len(records)
+        except Exception as e:
+            # Includes pyarrow's type errors; a bad batch must not kill the logger thread
+            with conversation_log_lock:
+                CONVERSATION_LOG_STATS["dropped"] += len(records)
+                CONVERSATION_LOG_STATS["last_error"] = str(e)
+    return len(records)
+
+def run_conversation_logger():
+    """Flush the log queue whenever a batch fills up or the flush interval passes."""
+    last_flush = time.monotonic()
+    while True:
+        time.sleep(1)
+        if (conversation_log_queue.qsize() >= CONVERSATION_LOG_BATCH_SIZE
+                or time.monotonic() - last_flush >= CONVERSATION_LOG_FLUSH_SECONDS):
+            while flush_conversation_log(CONVERSATION_LOG_BATCH_SIZE) == CONVERSATION_LOG_BATCH_SIZE:
+                pass
+            last_flush = time.monotonic()
+
+def start_conversation_logger():
+    """Start the background conversation logger once per process."""
+    global conversation_logger_thread
+    if conversation_logger_thread is not None and conversation_logger_thread.is_alive():
+        return
+    with conversation_log_lock:
+        if conversation_logger_thread is None or not conversation_logger_thread.is_alive():
+            conversation_logger_thread = threading.Thread(target=run_conversation_logger, name="conversation-logger", daemon=True)
+            conversation_logger_thread.start()
+            # Don't lose the last partial batch on shutdown
+            atexit.register(flush_conversation_log)
+
+def get_conversation_log_stats() -> Dict[str, Any]:
+    """Return counts of queued, written and dropped conversation turns."""
+    with conversation_log_lock:
+        stats = dict(CONVERSATION_LOG_STATS)
+    stats["queued"] = conversation_log_queue.qsize()
+    return stats
+
+def read_conversation_logs(log_dir: str, columns: list) -> Dict[str, list]:
+    """Read the given columns from the gzipped CSV logs written without pyarrow."""
+    data = {column: [] for column in columns}
+    for path in sorted(Path(log_dir).glob("date=*/*.csv.gz")):
+        with gzip.open(path, "rt", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                for column in columns:
+                    data[column].append(row.get(column))
+    return data
+
+def read_conversation_log_table(log_dir: str, schema) -> "pa.Table":
+    """Scan every date= partition under log_dir as one Arrow dataset, reading only the schema's columns."""
+    tables = []
+    for file_format, pattern in (("parquet", "date=*/*.parquet"), ("csv", "date=*/*.csv.gz")):
+        paths = [str(path) for path in sorted(Path(log_dir).glob(pattern))]
+        if paths:
+            dataset = ds.dataset(paths, format=file_format, schema=schema)
+            tables.append(dataset.to_table(columns=schema.names))
+    return pa.concat_tables(tables) if tables else schema.empty_table()
+
+def percentile(values: list, fraction: float) -> float:
+    """Return the nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize_conversation_logs(log_dir: str = "logs/conversations", top_n: int = 10) -> Dict[str, Any]:
+    """Summarize top questions, latency distributions and cache opportunities from the logs."""
+    if pa is not None:
+        return summarize_conversation_table(read_conversation_log_table(log_dir, pa.schema([
+            ("normalized_query", pa.string()),
+            ("source", pa.string()),
+            ("latency_ms", pa.float64())
+        ])), top_n)
+    
+    data = read_conversation_logs(log_dir, ["normalized_query", "source", "latency_ms"])
+    
+    question_counts = {}
+    upstream_counts = {}
+    latencies_by_source = {}
+    for question, source, latency in zip(data["normalized_query"], data["source"], data["latency_ms"]):
+        question_counts[question] = question_counts.get(question, 0) + 1
+        if source == "upstream":
+            upstream_counts[question] = upstream_counts.get(question, 0) + 1
+        latencies_by_source.setdefault(source or "unknown", []).append(float(latency or 0))
+    
+    # Repeats of a question that still went upstream could have been served from a cache
+    repeated_upstream = {question: count for question, count in upstream_counts.items() if count > 1}
+    
+    return {
+        "turns": len(data["source"]),
+        "top_questions": sorted(question_counts.items(), key=lambda item: item[1], reverse=True)[:top_n],
+        "latency_ms": {
+            source: {
+                "count": len(latencies),
+                "p50": percentile(latencies, 0.5),
+                "p90": percentile(latencies, 0.9),
+                "p99": percentile(latencies, 0.99)
+            }
+            for source, latencies in sorted(latencies_by_source.items())
+        },
+        "cacheable_upstream_calls": sum(count - 1 for count in repeated_upstream.values()),
+        "top_cache_opportunities": sorted(repeated_upstream.items(), key=lambda item: item[1], reverse=True)[:top_n]
+    }
+
+def count_questions(table: "pa.Table") -> "pa.Table":
+    """Count turns per normalized question in Arrow, most frequent first."""
+    counts = table.group_by("normalized_query").aggregate([("normalized_query", "count")])
+    return counts.sort_by([("normalized_query_count", "descending"), ("normalized_query", "ascending")])
+
+def top_question_pairs(counts: "pa.Table", top_n: int) -> list:
+    """Return the first top_n (question, count) pairs of a count_questions table."""
+    counts = counts.slice(0, top_n)
+    return list(zip(counts["normalized_query"].to_pylist(), counts["normalized_query_count"].to_pylist()))
+
+def summarize_conversation_table(table: "pa.Table", top_n: int) -> Dict[str, Any]:
+    """Summarize a table of logged turns with Arrow group-bys, without converting rows to Python."""
+    source = pc.if_else(pc.equal(pc.fill_null(table["source"], ""), ""), "unknown", table["source"])
+    table = table.set_column(table.schema.get_field_index("source"), "source", source)
+    latency = pc.fill_null(table["latency_ms"], 0.0)
+    
+    latency_ms = {}
+    for source_name in sorted(pc.unique(table["source"]).to_pylist()):
+        latencies = pc.filter(latency, pc.equal(table["source"], source_name))
+        p50, p90, p99 = pc.quantile(latencies, q=[0.5, 0.9, 0.99], interpolation="lower").to_pylist()
+        latency_ms[source_name] = {"count": len(latencies), "p50": p50, "p90": p90, "p99": p99}
+    
+    # Repeats of a question that still went upstream could have been served from a cache
+    upstream_counts = count_questions(table.filter(pc.equal(table["source"], "upstream")))
+    repeated_upstream = upstream_counts.filter(pc.greater(upstream_counts["normalized_query_count"], 1))
+    cacheable = pc.sum(pc.subtract(repeated_upstream["normalized_query_count"], 1)).as_py()
+    
+    return {
+        "turns": table.num_rows,
+        "top_questions": top_question_pairs(count_questions(table), top_n),
+        "latency_ms": latency_ms,
+        "cacheable_upstream_calls": cacheable or 0,
+        "top_cache_opportunities": top_question_pairs(repeated_upstream, top_n)
+    }
+
+# Hot-path timing, aggregated across every session in this process.
+# Phase paths are ";"-joined stacks such as "main;user_interface;css".
+PHASE_STATS = {}
+RECENT_RUNS = deque(maxlen=100)
+phase_stats_lock = threading.Lock()
+phase_timing = threading.local()
+
+@contextmanager
+def timed_phase(name: str, idle: bool = False):
+    """Time a phase of the current run, nested under any enclosing phases.
+    
+    Idle phases (waiting on a background job) are left out of the run times.
+    """
+    stack = getattr(phase_timing, "stack", None)
+    if stack is None:
+        stack = phase_timing.stack = []
+    if not stack:
+        phase_timing.idle = 0.0
+    
+    stack.append(name)
+    path = ";".join(stack)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        # st.rerun() raises through here, so record in finally
+        elapsed = time.perf_counter() - start_time
+        stack.pop()
+        if idle:
+            phase_timing.idle += elapsed
+        with phase_stats_lock:
+            stats = PHASE_STATS.setdefault(path, {"count": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            if path == "main":
+                RECENT_RUNS.append((time.time(), elapsed - phase_timing.idle))
+
+def get_phase_stats() -> Dict[str, Dict[str, float]]:
+    """Return a snapshot of the aggregated phase timings."""
+    with phase_stats_lock:
+        return {path: dict(stats) for path, stats in PHASE_STATS.items()}
+
+def get_folded_stacks() -> str:
+    """Return phase timings in folded-stack format (self time in microseconds) for flame graph tools."""
+    stats = get_phase_stats()
+    
+    lines = []
+    for path, path_stats in sorted(stats.items()):
+        children_total = sum(
+            child_stats["total"]
+            for child_path, child_stats in stats.items()
+            if child_path.startswith(path + ";") and child_path.count(";") == path.count(";") + 1
+        )
+        self_time = max(path_stats["total"] - children_total, 0.0)
+        lines.append(f"{path} {int(self_time * 1_000_000)}")
+    return "\n".join(lines)
+
+def reset_phase_stats():
+    """Clear the aggregated phase timings."""
+    with phase_stats_lock:
+        PHASE_STATS.clear()
+        RECENT_RUNS.clear()
+
+profiler_lock = threading.Lock()
+
+@contextmanager
+def profiled_run():
+    """Profile a sampled fraction of runs with cProfile and write the stats to disk."""
+    sample_rate = get_setting("profiling_sample_rate", 0.01) if get_setting("profiling_enabled", False) else 0.0
+    
+    # Only one run is profiled at a time; cProfile is process-wide on Python 3.12+
+    if not sample_rate or random.random() >= sample_rate or not profiler_lock.acquire(blocking=False):
+        yield
+        return
+    
+    profiler = None
+    try:
+        try:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        except ValueError:
+            # Another profiler (or debugger) already holds the process-wide hook
+            profiler = None
+        yield
+    finally:
+        try:
+            if profiler is not None:
+                profiler.disable()
+                profiles_dir = Path(get_setting("profiles_dir", "profiles"))
+                profiles_dir.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(profiles_dir / f"run-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}.prof")
+        except OSError:
+            # Profiling must never break a user's run
+            pass
+        finally:
+            profiler_lock.release()
+
+DEFAULT_SYSTEM_PROMPT = "You are Xenon Trader, a specialized trading assistant for the Deriv platform. \n\nYou can:\n✅ Respond to greetings warmly and introduce yourself as a trading specialist\n✅ Help with Deriv platform features and navigation\n✅ Provide trading strategies and market analysis\n✅ Discuss financial markets (Forex, Stocks, Commodities, Indices, Cryptocurrencies)\n✅ Teach risk management and trading education\n✅ Explain technical analysis and chart reading\n✅ Share trading psychology and discipline tips\n✅ Guide users on Deriv-specific tools and features\n\nWhen someone greets you, respond warmly and mention you're programmed specifically for trading assistance.\n\nIMPORTANT RESTRICTIONS:\n- For non-trading topics, politely say: 'My owner programmed me specifically for trading questions. Please ask about trading, market analysis, or Deriv features.'\n- Do NOT provide: general knowledge, entertainment, personal advice unrelated to trading, tech support for non-trading software\n- Stay focused on helping users become better traders\n\nBe helpful, professional, and trading-focused in your responses."
 
 def init_session_state():
     """Initialize session state variables."""
@@ -35,17 +687,45 @@ def init_session_state():
     
     defaults = {
         "api_key": saved_config.get("api_key", ""),
-        "system_prompt": saved_config.get("system_prompt", "You are Xenon Trader, a specialized trading assistant for the Deriv platform. \n\nYou can:\n✅ Respond to greetings warmly and introduce yourself as a trading specialist\n✅ Help with Deriv platform features and navigation\n✅ Provide trading strategies and market analysis\n✅ Discuss financial markets (Forex, Stocks, Commodities, Indices, Cryptocurrencies)\n✅ Teach risk management and trading education\n✅ Explain technical analysis and chart reading\n✅ Share trading psychology and discipline tips\n✅ Guide users on Deriv-specific tools and features\n\nWhen someone greets you, respond warmly and mention you're programmed specifically for trading assistance.\n\nIMPORTANT RESTRICTIONS:\n- For non-trading topics, politely say: 'My owner programmed me specifically for trading questions. Please ask about trading, market analysis, or Deriv features.'\n- Do NOT provide: general knowledge, entertainment, personal advice unrelated to trading, tech support for non-trading software\n- Stay focused on helping users become better traders\n\nBe helpful, professional, and trading-focused in your responses."),
+        "system_prompt": saved_config.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
         "chat_history": [],
+        "session_id": str(uuid.uuid4()),
         "admin_mode": False,
         "admin_password": "admin123",  # Change this to your preferred password
         "app_title": saved_config.get("app_title", "Xenon Trader Live Assistant"),
-        "welcome_message": saved_config.get("welcome_message", "Hello! I'm Xenon Trader, your live trading assistant. How can I help you with your trading today?")
+        "welcome_message": saved_config.get("welcome_message", "Hello! I'm Xenon Trader, your live trading assistant. How can I help you with your trading today?"),
+        "knowledge_base": saved_config.get("knowledge_base", ""),
+        "prompt_cache_mode": saved_config.get("prompt_cache_mode", True),
+        "fast_path_enabled": saved_config.get("fast_path_enabled", True),
+        "health_probe_interval": saved_config.get("health_probe_interval", 60),
+        "profiling_enabled": saved_config.get("profiling_enabled", False),
+        "profiling_sample_rate": saved_config.get("profiling_sample_rate", 0.01),
+        "profiles_dir": saved_config.get("profiles_dir", "profiles"),
+        "rate_limit_per_minute": saved_config.get("rate_limit_per_minute", 60),
+        "background_rate_share": saved_config.get("background_rate_share", 0.25),
+        "response_cache_ttl": saved_config.get("response_cache_ttl", 3600),
+        "conversation_log_enabled": saved_config.get("conversation_log_enabled", True),
+        "conversation_log_dir": saved_config.get("conversation_log_dir", "logs/conversations"),
+        "virtualized_chat": saved_config.get("virtualized_chat", True),
+        "chat_history_limit": saved_config.get("chat_history_limit", 20),
+        "tiered_routing": saved_config.get("tiered_routing", True),
+        "tier_complexity_threshold": saved_config.get("tier_complexity_threshold", 0.4),
+        "faq_enabled": saved_config.get("faq_enabled", True),
+        "faq_questions": saved_config.get("faq_questions", ""),
+        "faq_ttl": saved_config.get("faq_ttl", 24 * 3600)
     }
     
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
+    
+    # Pick up config saved by any worker since this session last loaded it
+    config_version = get_config_version()
+    if st.session_state.get("config_version") != config_version:
+        for key, value in defaults.items():
+            if key in saved_config:
+                st.session_state[key] = value
+        st.session_state.config_version = config_version
 
 def admin_panel():
     """Admin configuration panel."""
@@ -112,6 +792,19 @@ def admin_panel():
         height=100
     )
     
+    col1, col2 = st.columns(2)
+    st.session_state.virtualized_chat = col1.checkbox(
+        "Virtualized chat list",
+        value=st.session_state.virtualized_chat,
+        help="Mounts only the visible messages and loads older ones on scroll-up. Keeps long conversations fast on mobile."
+    )
+    st.session_state.chat_history_limit = int(col2.number_input(
+        "Messages kept per conversation",
+        min_value=2,
+        max_value=1000,
+        value=int(st.session_state.chat_history_limit)
+    ))
+    
     # System Prompt
     st.markdown("---")
     st.markdown("### 🤖 AI Behavior")
@@ -142,20 +835,390 @@ def admin_panel():
         help="This defines how the AI will behave and respond to users."
     )
     
+    st.session_state.knowledge_base = st.text_area(
+        "Knowledge Base",
+        value=st.session_state.knowledge_base,
+        height=200,
+        help="Static reference content sent with every request, right after the system prompt."
+    )
+    
+    # Prompt caching
+    st.markdown("---")
+    st.markdown("### ⚡ Prompt Caching")
+    
+    st.session_state.prompt_cache_mode = st.checkbox(
+        "Cache-friendly prompt assembly",
+        value=st.session_state.prompt_cache_mode,
+        help="Keeps the system prompt and knowledge base as a byte-stable prefix and sends cache hints where the provider supports them."
+    )
+    
+    cache_stats = get_cache_stats()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Requests with usage", cache_stats["requests"])
+    col2.metric("Request cache hit ratio", f"{cache_stats['request_hit_ratio']:.0%}")
+    col3.metric("Cached prompt tokens", f"{cache_stats['cached_tokens']} / {cache_stats['prompt_tokens']}", f"{cache_stats['token_hit_ratio']:.0%}")
+    
+    # Model tiers
+    st.markdown("---")
+    st.markdown("### 🪜 Model Tiers")
+    
+    col1, col2 = st.columns(2)
+    st.session_state.tiered_routing = col1.checkbox(
+        "Route simple questions to the small model",
+        value=st.session_state.tiered_routing,
+        help="Complex questions go to the large model. Small-model answers that look unsure or off-topic are retried on the large model."
+    )
+    st.session_state.tier_complexity_threshold = float(col2.number_input(
+        "Complexity threshold for the large model",
+        min_value=0.0,
+        max_value=1.0,
+        value=float(st.session_state.tier_complexity_threshold),
+        step=0.05
+    ))
+    
+    model_tiers = get_model_tiers()
+    with st.expander("Tier models and prices (USD per 1M tokens)"):
+        for provider, provider_tiers in model_tiers.items():
+            st.markdown(f"**{PROVIDERS[provider]['name']}**")
+            for tier, tier_config in provider_tiers.items():
+                col1, col2, col3 = st.columns([3, 1, 1])
+                tier_config["model"] = col1.text_input(
+                    f"{tier.capitalize()} model",
+                    value=tier_config["model"],
+                    key=f"tier_{provider}_{tier}_model"
+                )
+                tier_config["input_price"] = float(col2.number_input(
+                    "Input",
+                    min_value=0.0,
+                    value=float(tier_config["input_price"]),
+                    step=0.01,
+                    key=f"tier_{provider}_{tier}_input_price"
+                ))
+                tier_config["output_price"] = float(col3.number_input(
+                    "Output",
+                    min_value=0.0,
+                    value=float(tier_config["output_price"]),
+                    step=0.01,
+                    key=f"tier_{provider}_{tier}_output_price"
+                ))
+    st.session_state.model_tiers = model_tiers
+    
+    tier_stats = get_tier_stats()
+    if tier_stats:
+        st.table(tier_stats)
+    
+    # FAQ warm-up
+    st.markdown("---")
+    st.markdown("### 🔥 FAQ Warm-up")
+    
+    col1, col2 = st.columns(2)
+    st.session_state.faq_enabled = col1.checkbox(
+        "Serve precomputed FAQ answers",
+        value=st.session_state.faq_enabled,
+        help="Answers are generated at startup and after each save, and refreshed in the background once older than the TTL."
+    )
+    st.session_state.faq_ttl = int(col2.number_input(
+        "Refresh answers older than (seconds)",
+        min_value=60,
+        max_value=30 * 24 * 3600,
+        value=int(st.session_state.faq_ttl)
+    ))
+    
+    if st.button("Add top questions from conversation logs"):
+        top_questions = summarize_conversation_logs(st.session_state.conversation_log_dir, top_n=20)["top_questions"]
+        existing = set(normalize_query(question) for question in st.session_state.faq_questions.splitlines())
+        new_questions = [question for question, _ in top_questions if question not in existing and match_fast_path(question) is None]
+        st.session_state.faq_questions = "\n".join(filter(None, [st.session_state.faq_questions.strip()] + new_questions))
+    
+    st.session_state.faq_questions = st.text_area(
+        "FAQ questions (one per line)",
+        value=st.session_state.faq_questions,
+        height=150
+    )
+    
+    faq_stats = get_faq_stats()
+    st.caption(
+        f"Prompt version: {get_prompt_version(st.session_state.system_prompt)} · Served: {faq_stats['served']} · "
+        f"Generated: {faq_stats['warmed']} · Failed: {faq_stats['failed']} · Background refreshes: {faq_stats['refreshes']}"
+    )
+    
+    if st.button("Warm up now"):
+        if not st.session_state.api_key:
+            st.error("Please enter an API key first!")
+        else:
+            start_faq_warmup(st.session_state.system_prompt, st.session_state.api_key)
+            st.info("Warm-up started in the background.")
+    
+    # Instant replies
+    st.markdown("---")
+    st.markdown("### 💬 Instant Replies")
+    
+    st.session_state.fast_path_enabled = st.checkbox(
+        "Answer greetings, identity questions and off-topic questions locally",
+        value=st.session_state.fast_path_enabled,
+        help="These replies skip the upstream API call entirely."
+    )
+    
+    templates = get_response_templates()
+    with st.expander("Reply templates"):
+        for kind in DEFAULT_RESPONSE_TEMPLATES:
+            templates[kind] = st.text_area(
+                kind.capitalize(),
+                value=templates[kind],
+                height=100,
+                key=f"template_{kind}"
+            )
+    st.session_state.response_templates = templates
+    
+    fast_path_stats = get_fast_path_stats()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Instant replies", fast_path_stats["local_total"])
+    col2.metric("Upstream calls avoided", f"{fast_path_stats['avoided_ratio']:.0%}")
+    col3.metric("Avg instant reply time", f"{fast_path_stats['avg_local_ms']:.3f} ms")
+    if fast_path_stats["local_replies"]:
+        st.caption(", ".join(f"{kind}: {count}" for kind, count in sorted(fast_path_stats["local_replies"].items())))
+    
+    # Generation limits
+    st.markdown("---")
+    st.markdown("### 📏 Generation Limits")
+    st.caption("Limits are picked per query class: greeting, off_topic, short, follow_up (later turns) and detailed (long or strategy questions).")
+    
+    policy = get_generation_policy()
+    for query_class, class_policy in policy.items():
+        with st.expander(f"{query_class}"):
+            col1, col2 = st.columns(2)
+            class_policy["max_tokens"] = int(col1.number_input(
+                "Max tokens",
+                min_value=16,
+                max_value=4000,
+                value=int(class_policy["max_tokens"]),
+                key=f"policy_{query_class}_max_tokens"
+            ))
+            class_policy["temperature"] = float(col2.number_input(
+                "Temperature",
+                min_value=0.0,
+                max_value=2.0,
+                value=float(class_policy["temperature"]),
+                step=0.1,
+                key=f"policy_{query_class}_temperature"
+            ))
+            stop_text = st.text_input(
+                "Stop sequences (comma-separated)",
+                value=", ".join(class_policy["stop"]),
+                key=f"policy_{query_class}_stop"
+            )
+            class_policy["stop"] = [stop.strip() for stop in stop_text.split(",") if stop.strip()]
+            class_policy["model"] = st.text_input(
+                "Model override (blank = provider default)",
+                value=class_policy["model"],
+                key=f"policy_{query_class}_model"
+            )
+    st.session_state.generation_policy = policy
+    
+    generation_stats = get_generation_stats()
+    if generation_stats:
+        st.table(generation_stats)
+    else:
+        st.info("No measurements yet. Latency, token use and truncation per class appear here after the first requests.")
+    
     # Save configuration
     if st.button("💾 Save Configuration", type="primary"):
         config = {
             "api_key": st.session_state.api_key,
             "system_prompt": st.session_state.system_prompt,
             "app_title": st.session_state.app_title,
-            "welcome_message": st.session_state.welcome_message
+            "welcome_message": st.session_state.welcome_message,
+            "knowledge_base": st.session_state.knowledge_base,
+            "prompt_cache_mode": st.session_state.prompt_cache_mode,
+            "generation_policy": st.session_state.generation_policy,
+            "fast_path_enabled": st.session_state.fast_path_enabled,
+            "response_templates": st.session_state.response_templates,
+            "health_probe_interval": st.session_state.health_probe_interval,
+            "profiling_enabled": st.session_state.profiling_enabled,
+            "profiling_sample_rate": st.session_state.profiling_sample_rate,
+            "profiles_dir": st.session_state.profiles_dir,
+            "rate_limit_per_minute": st.session_state.rate_limit_per_minute,
+            "background_rate_share": st.session_state.background_rate_share,
+            "response_cache_ttl": st.session_state.response_cache_ttl,
+            "conversation_log_enabled": st.session_state.conversation_log_enabled,
+            "conversation_log_dir": st.session_state.conversation_log_dir,
+            "virtualized_chat": st.session_state.virtualized_chat,
+            "chat_history_limit": st.session_state.chat_history_limit,
+            "tiered_routing": st.session_state.tiered_routing,
+            "tier_complexity_threshold": st.session_state.tier_complexity_threshold,
+            "model_tiers": st.session_state.model_tiers,
+            "faq_enabled": st.session_state.faq_enabled,
+            "faq_questions": st.session_state.faq_questions,
+            "faq_ttl": st.session_state.faq_ttl
         }
         
         if save_config(config):
             st.success("✅ Configuration saved successfully!")
+            # Regenerate FAQ answers for a changed prompt before users ask
+            start_faq_warmup(st.session_state.system_prompt, st.session_state.api_key)
         else:
             st.warning("⚠️ Could not save configuration to file. Settings will be lost on restart.")
     
+    # Provider health
+    st.markdown("---")
+    st.markdown("### 🩺 Provider Health")
+    
+    st.session_state.health_probe_interval = int(st.number_input(
+        "Probe interval (seconds, 0 = off)",
+        min_value=0,
+        max_value=3600,
+        value=int(st.session_state.health_probe_interval),
+        help="A background thread pings the configured provider at this interval to keep connections warm and catch outages early."
+    ))
+    
+    provider_health = get_provider_health()
+    if provider_health:
+        status_icons = {"healthy": "🟢", "degraded": "🟡", "down": "🔴", "unknown": "⚪"}
+        st.table([
+            {
+                "provider": PROVIDERS[health_key.split(":")[0]]["name"],
+                "model": health_key.split(":", 1)[1] if ":" in health_key else "(probe)",
+                "status": f"{status_icons[health['status']]} {health['status']}",
+                "latency (s)": round(health["latency_ewma"], 2) if health["latency_ewma"] is not None else "-",
+                "error rate": f"{health['error_rate']:.0%}",
+                "samples": health["samples"],
+                "last checked": datetime.fromtimestamp(health["last_checked"]).strftime("%H:%M:%S") if health["last_checked"] else "-",
+                "last error": health["last_error"]
+            }
+            for health_key, health in provider_health.items()
+        ])
+    else:
+        st.info("No health data yet. The prober checks the saved API key shortly after startup.")
+    
+    # Shared state
+    st.markdown("---")
+    st.markdown("### 🗄️ Shared State (all workers)")
+    
+    st.caption(f"Backend: {type(get_shared_store()).__name__} · Config version: {get_config_version()}")
+    
+    col1, col2 = st.columns(2)
+    st.session_state.rate_limit_per_minute = int(col1.number_input(
+        "Upstream requests per minute (0 = unlimited)",
+        min_value=0,
+        max_value=10000,
+        value=int(st.session_state.rate_limit_per_minute),
+        help="Shared by every worker on this host."
+    ))
+    st.session_state.response_cache_ttl = int(col2.number_input(
+        "Response cache TTL (seconds, 0 = off)",
+        min_value=0,
+        max_value=7 * 24 * 3600,
+        value=int(st.session_state.response_cache_ttl)
+    ))
+    st.session_state.background_rate_share = st.slider(
+        "Share of the rate limit for FAQ warm-up and refreshes",
+        min_value=0.05,
+        max_value=1.0,
+        value=float(st.session_state.background_rate_share),
+        step=0.05,
+        help="Background generation never takes more than this share, so live users keep the rest."
+    )
+    
+    shared_metrics = get_shared_metrics()
+    if shared_metrics:
+        st.table([{"metric": name, "value": value} for name, value in sorted(shared_metrics.items())])
+    
+    # Conversation logs
+    st.markdown("---")
+    st.markdown("### 📒 Conversation Logs")
+    
+    col1, col2 = st.columns(2)
+    st.session_state.conversation_log_enabled = col1.checkbox(
+        "Log conversations",
+        value=st.session_state.conversation_log_enabled,
+        help="Turns are written in the background as Parquet (or gzipped CSV without pyarrow), partitioned by date."
+    )
+    st.session_state.conversation_log_dir = col2.text_input(
+        "Log directory",
+        value=st.session_state.conversation_log_dir
+    )
+    
+    log_stats = get_conversation_log_stats()
+    st.caption(
+        f"Format: {'Parquet' if pa is not None else 'CSV (install pyarrow for Parquet)'} · "
+        f"Queued: {log_stats['queued']} · Written: {log_stats['written']} · "
+        f"Files: {log_stats['files']} · Dropped: {log_stats['dropped']}"
+    )
+    if log_stats["last_error"]:
+        st.warning(f"Last write error: {log_stats['last_error']}")
+    
+    col1, col2 = st.columns(2)
+    if col1.button("Flush now"):
+        flush_conversation_log()
+        st.rerun()
+    if col2.button("Summarize logs"):
+        summary = summarize_conversation_logs(st.session_state.conversation_log_dir)
+        st.metric("Turns logged", summary["turns"])
+        st.markdown("**Top questions**")
+        st.table([{"question": question, "count": count} for question, count in summary["top_questions"]])
+        st.markdown("**Latency by source (ms)**")
+        st.table([dict(source=source, **stats) for source, stats in summary["latency_ms"].items()])
+        st.markdown(f"**Cache opportunities:** {summary['cacheable_upstream_calls']} upstream calls repeated an earlier question")
+        st.table([{"question": question, "upstream calls": count} for question, count in summary["top_cache_opportunities"]])
+    
+    # Performance
+    st.markdown("---")
+    st.markdown("### ⏱️ Performance")
+    
+    job_stats = get_job_stats()
+    st.caption(f"Generation jobs in this worker · Running: {job_stats['running']} · Done: {job_stats['done']} · Failed: {job_stats['failed']}")
+    
+    phase_stats = get_phase_stats()
+    if phase_stats:
+        with phase_stats_lock:
+            recent_runs = [elapsed for _, elapsed in RECENT_RUNS]
+        if recent_runs:
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Runs recorded", phase_stats.get("main", {}).get("count", 0))
+            col2.metric("Avg run (last 100)", f"{sum(recent_runs) / len(recent_runs) * 1000:.0f} ms")
+            col3.metric("Slowest run (last 100)", f"{max(recent_runs) * 1000:.0f} ms")
+        
+        # Flame-style breakdown: one bar per phase, width relative to its root phase
+        flame_html = '<div style="font-family: monospace; font-size: 12px;">'
+        for path, stats in sorted(phase_stats.items()):
+            depth = path.count(";")
+            root_total = phase_stats.get(path.split(";")[0], stats)["total"] or 1.0
+            width = max(stats["total"] / root_total * 100, 1)
+            avg_ms = stats["total"] / stats["count"] * 1000
+            flame_html += (
+                f'<div style="margin-left: {depth * 16}px; width: {width:.1f}%; background: hsl({30 + depth * 25}, 85%, 60%); '
+                f'padding: 2px 6px; margin-bottom: 2px; white-space: nowrap; overflow: visible;">'
+                f'{path.split(";")[-1]} · avg {avg_ms:.1f} ms · max {stats["max"] * 1000:.1f} ms · ×{stats["count"]}</div>'
+            )
+        flame_html += '</div>'
+        st.markdown(flame_html, unsafe_allow_html=True)
+        
+        col1, col2 = st.columns(2)
+        col1.download_button("Download folded stacks", get_folded_stacks(), file_name="xenon-phases.folded")
+        if col2.button("Reset timings"):
+            reset_phase_stats()
+            st.rerun()
+    else:
+        st.info("No timings yet.")
+    
+    st.session_state.profiling_enabled = st.checkbox(
+        "Sampling profiler (cProfile)",
+        value=st.session_state.profiling_enabled,
+        help="Profiles a random sample of runs and writes .prof files for offline analysis (e.g. snakeviz)."
+    )
+    col1, col2 = st.columns(2)
+    st.session_state.profiling_sample_rate = float(col1.number_input(
+        "Sample rate (fraction of runs)",
+        min_value=0.0,
+        max_value=1.0,
+        value=float(st.session_state.profiling_sample_rate),
+        step=0.01
+    ))
+    st.session_state.profiles_dir = col2.text_input(
+        "Profile directory",
+        value=st.session_state.profiles_dir
+    )
+    
     # Test API
     st.markdown("---")
     st.markdown("### 🧪 Test API Connection")
@@ -168,7 +1231,10 @@ def admin_panel():
                 test_response = process_query(
                     "Hello, please respond with 'API test successful!'",
                     "You are a helpful assistant. Respond exactly as requested.",
-                    st.session_state.api_key
+                    st.session_state.api_key,
+                    use_fast_path=False,
+                    history=[],
+                    diagnostic=True
                 )
                 
                 if "API test successful" in test_response:
@@ -178,18 +1244,8 @@ def admin_panel():
                 else:
                     st.warning(f"⚠️ Unexpected response: {test_response}")
 
-def user_interface():
-    """Main user chat interface."""
-    
-    # Check if app is configured
-    if not st.session_state.api_key or not st.session_state.system_prompt:
-        st.warning("⚙️ This AI assistant is not yet configured. Please contact the administrator.")
-        st.info("🔧 Admin: Add ?admin=true to the URL to configure this assistant.")
-        return
-    
-    
-    # Custom CSS for fixed layout + Hide Streamlit branding
-    st.markdown("""
+# Custom CSS for fixed layout + Hide Streamlit branding
+CHAT_CSS = """
     <style>
     /* Hide Streamlit branding */
     #MainMenu {visibility: hidden;}
@@ -497,8 +1553,256 @@ def user_interface():
         pointer-events: none;
     }
     
+    /* Virtualized chat iframe takes the chat area's place */
+    iframe[srcdoc*="xenon-virtual-chat"] {
+        position: fixed;
+        top: 70px;
+        left: 0;
+        right: 0;
+        width: 100% !important;
+        height: calc(100vh - 170px) !important;
+        border: none;
+    }
+    
+    @media (max-width: 768px) {
+        iframe[srcdoc*="xenon-virtual-chat"] {
+            top: 60px;
+            height: calc(100vh - 180px) !important;
+        }
+    }
+    
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+# Virtualized chat list, rendered in a component iframe. Only the messages in view
+# (plus a small overscan) are mounted, and older messages are loaded a page at a
+# time when the user scrolls up, so layout and paint cost stay flat as history grows.
+VIRTUAL_CHAT_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+<meta name="xenon-virtual-chat">
+<style>
+html, body { margin: 0; height: 100%; font-family: "Source Sans Pro", sans-serif; }
+#viewport {
+    position: absolute; inset: 0; overflow-y: auto; -webkit-overflow-scrolling: touch;
+    background: linear-gradient(135deg, #f5f7fa 0%, #c3cfe2 100%);
+}
+#spacer { position: relative; width: 100%; }
+.row { position: absolute; left: 0; right: 0; padding: 5px 15px; box-sizing: border-box; contain: layout paint; }
+.bubble {
+    color: white; padding: 15px 20px; font-size: 16px; line-height: 1.4;
+    max-width: 70%; white-space: pre-wrap; word-wrap: break-word;
+}
+.user .bubble {
+    background: #6f62c7; border-radius: 20px 20px 5px 20px; margin-left: auto; margin-right: 5px;
+}
+.bot .bubble { background: #f3708e; border-radius: 20px 20px 20px 5px; }
+.row.new .bubble { animation: fadeIn 0.3s ease-out; }
+.speak-button {
+    display: block; margin-top: 10px; border: none; border-radius: 12px; padding: 4px 10px;
+    background: rgba(255,255,255,0.25); color: white; cursor: pointer;
+}
+.typing-dot {
+    display: inline-block; width: 8px; height: 8px; margin-left: 3px; border-radius: 50%;
+    background: white; animation: typingDot 1.4s infinite ease-in-out;
+}
+.typing-dot:nth-child(1) { animation-delay: -0.32s; }
+.typing-dot:nth-child(2) { animation-delay: -0.16s; }
+@keyframes typingDot { 0%, 80%, 100% { opacity: 0.3; } 40% { opacity: 1; } }
+@keyframes fadeIn { from { opacity: 0; } to { opacity: 1; } }
+@media (max-width: 768px) {
+    .row { padding: 4px 10px; }
+    .bubble { font-size: 14px; padding: 12px 16px; max-width: 85%; }
+}
+</style>
+</head>
+<body>
+<div id="viewport"><div id="spacer"></div></div>
+<script>
+const messages = __MESSAGES__;
+const typing = __TYPING__;
+const PAGE_SIZE = 30;        // messages loaded per scroll-up
+const OVERSCAN = 4;          // rows mounted above and below the visible range
+const ESTIMATED_HEIGHT = 90; // used until a row has been measured
+
+const viewport = document.getElementById('viewport');
+const spacer = document.getElementById('spacer');
+const count = messages.length + (typing ? 1 : 0);
+const heights = new Array(count).fill(0);
+const mounted = new Map();
+let loadedStart = Math.max(0, count - PAGE_SIZE);
+let offsets = [];
+let scheduled = false;
+
+function heightOf(i) { return heights[i] || ESTIMATED_HEIGHT; }
+
+function layout() {
+    offsets = [];
+    let top = 0;
+    for (let i = loadedStart; i < count; i++) {
+        offsets.push(top);
+        top += heightOf(i);
+    }
+    spacer.style.height = top + 'px';
+    return top;
+}
+
+function firstVisible(scrollTop) {
+    let low = 0, high = offsets.length - 1;
+    while (low < high) {
+        const mid = (low + high + 1) >> 1;
+        if (offsets[mid] <= scrollTop) { low = mid; } else { high = mid - 1; }
+    }
+    return loadedStart + low;
+}
+
+function speak(text) {
+    const utterance = new SpeechSynthesisUtterance(text);
+    utterance.rate = 0.8;
+    utterance.pitch = 1;
+    utterance.volume = 1;
+    speechSynthesis.speak(utterance);
+}
+
+function createRow(i) {
+    const row = document.createElement('div');
+    const bubble = document.createElement('div');
+    bubble.className = 'bubble';
+    if (i >= messages.length) {
+        row.className = 'row bot';
+        bubble.textContent = '🤖 Xenon is typing ';
+        for (let d = 0; d < 3; d++) {
+            const dot = document.createElement('span');
+            dot.className = 'typing-dot';
+            bubble.appendChild(dot);
+        }
+    } else {
+        const message = messages[i];
+        const isUser = message.role === 'user';
+        row.className = 'row ' + (isUser ? 'user' : 'bot');
+        bubble.textContent = (isUser ? '👤 ' : '🤖 ') + message.content;
+        if (!isUser && message.speak !== false) {
+            const button = document.createElement('button');
+            button.className = 'speak-button';
+            button.textContent = '🔊 Speak';
+            button.onclick = () => speak(message.content);
+            bubble.appendChild(button);
+        }
+    }
+    // Only the newest message animates in
+    if (i === count - 1) { row.classList.add('new'); }
+    row.appendChild(bubble);
+    return row;
+}
+
+function render() {
+    scheduled = false;
+    const scrollTop = viewport.scrollTop;
+    const start = Math.max(loadedStart, firstVisible(scrollTop) - OVERSCAN);
+    let end = firstVisible(scrollTop + viewport.clientHeight) + OVERSCAN;
+    end = Math.min(count - 1, end);
+
+    for (const [i, row] of mounted) {
+        if (i < start || i > end) { row.remove(); mounted.delete(i); }
+    }
+
+    let anchorShift = 0;
+    let remeasured = false;
+    for (let i = start; i <= end; i++) {
+        let row = mounted.get(i);
+        if (!row) {
+            row = createRow(i);
+            spacer.appendChild(row);
+            mounted.set(i, row);
+        }
+        const measured = row.offsetHeight;
+        if (measured !== heights[i]) {
+            // Keep the content in view steady when rows above it change height
+            if (offsets[i - loadedStart] < scrollTop) { anchorShift += measured - heightOf(i); }
+            heights[i] = measured;
+            remeasured = true;
+        }
+    }
+
+    const atBottom = scrollTop + viewport.clientHeight >= spacer.offsetHeight - 5;
+    if (remeasured) { layout(); }
+    for (const [i, row] of mounted) {
+        row.style.transform = 'translateY(' + offsets[i - loadedStart] + 'px)';
+    }
+    if (atBottom) {
+        viewport.scrollTop = spacer.offsetHeight;
+    } else if (anchorShift) {
+        viewport.scrollTop = scrollTop + anchorShift;
+    }
+    // Real heights can change which rows are visible; repeat until they settle
+    if (remeasured) { scheduleRender(); }
+}
+
+function scheduleRender() {
+    if (!scheduled) {
+        scheduled = true;
+        requestAnimationFrame(render);
+    }
+}
+
+viewport.addEventListener('scroll', () => {
+    // Lazily load an older page when the user nears the top
+    if (viewport.scrollTop < 200 && loadedStart > 0) {
+        const previousStart = loadedStart;
+        loadedStart = Math.max(0, loadedStart - PAGE_SIZE);
+        let added = 0;
+        for (let i = loadedStart; i < previousStart; i++) { added += heightOf(i); }
+        layout();
+        viewport.scrollTop += added;
+    }
+    scheduleRender();
+}, { passive: true });
+
+window.addEventListener('resize', () => {
+    heights.fill(0);
+    layout();
+    scheduleRender();
+});
+
+layout();
+viewport.scrollTop = spacer.offsetHeight;
+render();
+</script>
+</body>
+</html>
+"""
+
+def render_virtual_chat(chat_history: list, welcome_message: str, is_typing: bool):
+    """Render the chat history as a virtualized list in a component iframe."""
+    messages = [{"role": item["role"], "content": item["content"]} for item in chat_history]
+    if not messages:
+        messages = [{"role": "assistant", "content": welcome_message, "speak": False}]
+    
+    # Escape "</" so message text can't close the script tag
+    html = VIRTUAL_CHAT_HTML.replace(
+        "__MESSAGES__", json.dumps(messages).replace("</", "<\\/")
+    ).replace(
+        "__TYPING__", "true" if is_typing else "false"
+    )
+    components.html(html, height=600)
+
+def user_interface():
+    """Main user chat interface."""
+    
+    # Check if app is configured
+    if not st.session_state.api_key or not st.session_state.system_prompt:
+        st.warning("⚙️ This AI assistant is not yet configured. Please contact the administrator.")
+        st.info("🔧 Admin: Add ?admin=true to the URL to configure this assistant.")
+        return
+    
+    # Pick up the conversation (and any answer in progress) after a reconnect
+    resume_conversation()
+    
+    
+    # Custom CSS for fixed layout + Hide Streamlit branding
+    with timed_phase("css"):
+        st.markdown(CHAT_CSS, unsafe_allow_html=True)
     
     # Beautiful header
     st.markdown("""
@@ -511,48 +1815,61 @@ def user_interface():
     </div>
     """, unsafe_allow_html=True)
     
-    # Chat area with messages
-    chat_html = '<div class="chat-area" id="chat-area">'
-    
-    # Add welcome message if no chat history
-    if not st.session_state.chat_history:
-        chat_html += f'''
-        <div class="bot-message">
-            🤖 {st.session_state.welcome_message}
-        </div>
-        '''
-    
-    # Display chat history
-    for i, item in enumerate(st.session_state.chat_history):
-        if item["role"] == "user":
-            chat_html += f'<div class="user-message">👤 {item["content"]}</div>'
-        else:
-            # Escape quotes for JavaScript
-            clean_content = item["content"].replace("'", "\\'").replace('"', '\\"').replace('`', '\\`')
-            chat_html += f'''
-            <div class="bot-message">
-                🤖 {item["content"]}
-                <br><br><button class="speak-button" onclick="speakText('{clean_content}')">🔊 Speak</button>
-            </div>
-            '''
-    
-    # Show typing indicator if processing
-    if "is_typing" in st.session_state and st.session_state.is_typing:
-        chat_html += '''
-        <div class="typing-indicator">
-            🤖 Xenon is typing
-            <div class="typing-dots">
-                <div class="typing-dot"></div>
-                <div class="typing-dot"></div>
-                <div class="typing-dot"></div>
-            </div>
-        </div>
-        '''
-    
-    chat_html += '</div>'
+    virtualized = get_setting("virtualized_chat", True)
     
-    # Display chat area
-    st.markdown(chat_html, unsafe_allow_html=True)
+    if virtualized:
+        # Only the visible messages are mounted, so cost stays flat as history grows
+        with timed_phase("render_chat"):
+            render_virtual_chat(
+                st.session_state.chat_history,
+                st.session_state.welcome_message,
+                st.session_state.get("is_typing", False)
+            )
+    else:
+        # Chat area with messages
+        with timed_phase("chat_html"):
+            chat_html = '<div class="chat-area" id="chat-area">'
+    
+            # Add welcome message if no chat history
+            if not st.session_state.chat_history:
+                chat_html += f'''
+                <div class="bot-message">
+                    🤖 {st.session_state.welcome_message}
+                </div>
+                '''
+    
+            # Display chat history
+            for i, item in enumerate(st.session_state.chat_history):
+                if item["role"] == "user":
+                    chat_html += f'<div class="user-message">👤 {item["content"]}</div>'
+                else:
+                    # Escape quotes for JavaScript
+                    clean_content = item["content"].replace("'", "\\'").replace('"', '\\"').replace('`', '\\`')
+                    chat_html += f'''
+                    <div class="bot-message">
+                        🤖 {item["content"]}
+                        <br><br><button class="speak-button" onclick="speakText('{clean_content}')">🔊 Speak</button>
+                    </div>
+                    '''
+    
+            # Show typing indicator if processing
+            if "is_typing" in st.session_state and st.session_state.is_typing:
+                chat_html += '''
+                <div class="typing-indicator">
+                    🤖 Xenon is typing
+                    <div class="typing-dots">
+                        <div class="typing-dot"></div>
+                        <div class="typing-dot"></div>
+                        <div class="typing-dot"></div>
+                    </div>
+                </div>
+                '''
+    
+            chat_html += '</div>'
+    
+        # Display chat area
+        with timed_phase("render_chat"):
+            st.markdown(chat_html, unsafe_allow_html=True)
     
     # Input controls (positioned by CSS)
     col1, col2 = st.columns([4, 1])
@@ -566,49 +1883,52 @@ def user_interface():
     <div class="custom-footer"></div>
     """, unsafe_allow_html=True)
     
-    # JavaScript for text-to-speech and auto-scroll
-    st.markdown("""
-    <script>
-    function speakText(text) {
-        const utterance = new SpeechSynthesisUtterance(text);
-        utterance.rate = 0.8;
-        utterance.pitch = 1;
-        utterance.volume = 1;
-        speechSynthesis.speak(utterance);
-    }
-    
-    // Auto-scroll to bottom of chat
-    function scrollToBottom() {
-        const chatArea = document.getElementById('chat-area');
-        if (chatArea) {
-            chatArea.scrollTop = chatArea.scrollHeight;
+    if not virtualized:
+        # JavaScript for text-to-speech and auto-scroll
+        st.markdown("""
+        <script>
+        function speakText(text) {
+            const utterance = new SpeechSynthesisUtterance(text);
+            utterance.rate = 0.8;
+            utterance.pitch = 1;
+            utterance.volume = 1;
+            speechSynthesis.speak(utterance);
+        }
+    
+        // Auto-scroll to bottom of chat
+        function scrollToBottom() {
+            const chatArea = document.getElementById('chat-area');
+            if (chatArea) {
+                chatArea.scrollTop = chatArea.scrollHeight;
+            }
+            // Also scroll the main window
+            window.scrollTo(0, document.body.scrollHeight);
+        }
+    
+        // Continuous scroll during typing animation
+        function autoScrollDuringTyping() {
+            const typingIndicator = document.querySelector('.typing-indicator');
+            if (typingIndicator && typingIndicator.style.display !== 'none') {
+                scrollToBottom();
+                setTimeout(autoScrollDuringTyping, 200); // Keep scrolling every 200ms while typing
+            }
         }
-        // Also scroll the main window
-        window.scrollTo(0, document.body.scrollHeight);
-    }
     
-    // Continuous scroll during typing animation
-    function autoScrollDuringTyping() {
-        const typingIndicator = document.querySelector('.typing-indicator');
-        if (typingIndicator && typingIndicator.style.display !== 'none') {
+        // Enhanced scroll function
+        function enhancedScroll() {
             scrollToBottom();
-            setTimeout(autoScrollDuringTyping, 200); // Keep scrolling every 200ms while typing
+            autoScrollDuringTyping();
         }
-    }
     
-    // Enhanced scroll function
-    function enhancedScroll() {
-        scrollToBottom();
-        autoScrollDuringTyping();
-    }
+        // Scroll to bottom when page loads and start monitoring
+        setTimeout(enhancedScroll, 100);
     
-    // Scroll to bottom when page loads and start monitoring
-    setTimeout(enhancedScroll, 100);
+        // Also scroll on any new content (rerun detection)
+        setInterval(enhancedScroll, 500);
+        </script>
+        """, unsafe_allow_html=True)
     
-    // Also scroll on any new content (rerun detection)
-    setInterval(enhancedScroll, 500);
-    </script>
-    """, unsafe_allow_html=True)
+    session_id = st.session_state.session_id
     
     # Process user input with typing animation - only on button click to avoid loops
     if ask_button and query.strip():
@@ -618,7 +1938,21 @@ def user_interface():
             st.session_state.is_typing = True
             
             # Add user message to chat history
-            st.session_state.chat_history.append({"role": "user", "content": query.strip()})
+            message_id = uuid.uuid4().hex[:12]
+            st.session_state.chat_history.append({"role": "user", "content": query.strip(), "id": message_id})
+            st.session_state.pending_message_id = message_id
+            
+            # Generate in the background so this run isn't blocked on the upstream call
+            submit_generation_job(
+                session_id,
+                message_id,
+                query.strip(),
+                st.session_state.system_prompt,
+                st.session_state.api_key,
+                st.session_state.chat_history,
+                snapshot_settings()
+            )
+            save_conversation(session_id, st.session_state.chat_history, message_id)
             
             # Rerun to show typing indicator
             st.rerun()
@@ -626,29 +1960,52 @@ def user_interface():
     # Handle AI response generation (separate from input processing)
     if "is_typing" in st.session_state and st.session_state.is_typing:
         # Get the last user message
-        last_user_message = None
+        last_user_item = None
         for item in reversed(st.session_state.chat_history):
             if item["role"] == "user":
-                last_user_message = item["content"]
+                last_user_item = item
                 break
         
-        if last_user_message:
-            # Get AI response
-            response = process_query(
-                last_user_message,
-                st.session_state.system_prompt,
-                st.session_state.api_key
-            )
+        if last_user_item:
+            if "id" not in last_user_item:
+                last_user_item["id"] = st.session_state.get("pending_message_id") or uuid.uuid4().hex[:12]
+            message_id = last_user_item["id"]
+            
+            with timed_phase("find_job"):
+                job = get_generation_job(session_id, message_id)
+                if job is None:
+                    # The job was lost (e.g. the worker restarted): start it again
+                    job = submit_generation_job(
+                        session_id,
+                        message_id,
+                        last_user_item["content"],
+                        st.session_state.system_prompt,
+                        st.session_state.api_key,
+                        st.session_state.chat_history,
+                        snapshot_settings()
+                    )
+            
+            # Show the answer the moment the job finishes. Only rerun (a full page render)
+            # if it's still running after the timeout, e.g. to pick up a lost job
+            with timed_phase("wait_for_job", idle=True):
+                job = wait_for_generation_job(session_id, message_id, job, get_setting("job_wait_timeout", 5))
+            if job is None or job["status"] == "running":
+                st.rerun()
+            
+            response = job["response"]
             
             # Add AI response to chat history
             st.session_state.chat_history.append({"role": "assistant", "content": response})
             
-            # Keep only last 20 messages to avoid token limits
-            if len(st.session_state.chat_history) > 20:
-                st.session_state.chat_history = st.session_state.chat_history[-20:]
+            # Keep only the most recent messages (the model only sees the last 6)
+            history_limit = get_setting("chat_history_limit", 20)
+            if len(st.session_state.chat_history) > history_limit:
+                st.session_state.chat_history = st.session_state.chat_history[-history_limit:]
             
             # Remove typing indicator
             st.session_state.is_typing = False
+            st.session_state.pending_message_id = None
+            save_conversation(session_id, st.session_state.chat_history)
             
             # Rerun to show response
             st.rerun()
@@ -683,116 +2040,724 @@ def is_greeting_or_polite(text: str) -> bool:
 
 def filter_response(response: str, user_question: str) -> str:
     """Filter AI response to ensure it's trading-focused."""
+    return filter_response_verdict(response, user_question)[0]
+
+def filter_response_verdict(response: str, user_question: str) -> tuple:
+    """Filter AI response and return it with the filter's verdict."""
     
     # Allow greetings and polite interactions
     if is_greeting_or_polite(user_question):
-        return response
+        return response, "greeting"
     
     # Check if user question is trading-related
     if not is_trading_related(user_question):
-        return "My owner programmed me specifically for trading questions. Please ask me about trading strategies, market analysis, Deriv platform features, or anything related to financial markets. How can I help you with your trading today?"
+        return get_response_templates()["refusal"], "refused_off_topic"
     
     # Check if AI response is trading-related (but allow greetings in responses)
     if not is_trading_related(response) and not is_greeting_or_polite(response):
-        return "I'm here to help you with trading and Deriv platform questions. Let me know what you'd like to learn about trading strategies, market analysis, or Deriv features!"
+        return "I'm here to help you with trading and Deriv platform questions. Let me know what you'd like to learn about trading strategies, market analysis, or Deriv features!", "replaced_off_topic"
+    
+    return response, "passed"
+
+# Instant replies sent without an upstream call (admin-editable, saved as "response_templates")
+DEFAULT_RESPONSE_TEMPLATES = {
+    "greeting": "Hello! I'm Xenon Trader, your trading assistant. I'm programmed specifically to help with trading strategies, market analysis, risk management and Deriv platform features. What would you like to know?",
+    "identity": "I'm Xenon Trader, a trading assistant built for the Deriv platform. I can explain trading strategies, technical analysis, risk management, trading psychology and Deriv features. Ask me anything about trading!",
+    "thanks": "You're welcome! Let me know if you have any other trading questions. Remember to always manage your risk.",
+    "goodbye": "Goodbye and happy trading! Come back anytime you need help with the markets or Deriv.",
+    "refusal": "My owner programmed me specifically for trading questions. Please ask me about trading strategies, market analysis, Deriv platform features, or anything related to financial markets. How can I help you with your trading today?"
+}
+
+# Whole-message phrases answered locally; anything longer goes upstream
+FAST_PATH_PHRASES = {
+    "greeting": [
+        'hi', 'hello', 'hey', 'hi there', 'hello there', 'hey there', 'greetings',
+        'good morning', 'good afternoon', 'good evening', 'yo', 'howdy', 'how are you'
+    ],
+    "identity": [
+        'who are you', 'what are you', 'what is your name', 'whats your name',
+        'what can you do', 'introduce yourself', 'tell me about yourself'
+    ],
+    "thanks": ['thanks', 'thank you', 'thanks a lot', 'thank you so much', 'thx', 'ok thanks'],
+    "goodbye": ['bye', 'goodbye', 'bye bye', 'see you', 'see you later']
+}
+
+# Local vs upstream dispatch counts, shared by every session in this process
+FAST_PATH_STATS = {"upstream_calls": 0, "local_replies": {}, "local_seconds": 0.0}
+fast_path_stats_lock = threading.Lock()
+
+def get_response_templates() -> Dict[str, str]:
+    """Return the instant-reply templates, with saved overrides applied to the defaults."""
+    templates = dict(DEFAULT_RESPONSE_TEMPLATES)
+    templates.update(get_setting("response_templates", {}) or {})
+    return templates
+
+def normalize_query(text: str) -> str:
+    """Lowercase a query and strip punctuation for phrase matching."""
+    cleaned = "".join(char if char.isalnum() or char.isspace() else " " for char in text.lower())
+    return " ".join(cleaned.split())
+
+def match_fast_path(query: str):
+    """Return the template kind that answers a query locally, or None."""
+    # Trading questions always need the model
+    if is_trading_related(query):
+        return None
+    
+    # filter_response would replace the model's answer with the refusal anyway
+    if not is_greeting_or_polite(query):
+        return "refusal"
+    
+    text = normalize_query(query)
+    for greeting in sorted(FAST_PATH_PHRASES["greeting"], key=len, reverse=True):
+        if text == greeting:
+            return "greeting"
+        if text.startswith(greeting + " "):
+            # "hi who are you" is an identity question
+            text = text[len(greeting) + 1:]
+            break
+    
+    for kind in ("identity", "thanks", "goodbye"):
+        if text in FAST_PATH_PHRASES[kind]:
+            return kind
+    
+    return None
+
+def fast_path_response(query: str):
+    """Answer greetings, identity questions and refusals locally, or return None."""
+    start_time = time.perf_counter()
+    kind = match_fast_path(query)
+    if kind is None:
+        return None
+    
+    response = get_response_templates()[kind]
+    
+    with fast_path_stats_lock:
+        FAST_PATH_STATS["local_replies"][kind] = FAST_PATH_STATS["local_replies"].get(kind, 0) + 1
+        FAST_PATH_STATS["local_seconds"] += time.perf_counter() - start_time
     
     return response
 
-def call_ai_api(messages: list, api_key: str, model: str = "deepseek-coder") -> Dict[Any, Any]:
-    """Call DeepSeek API, GitHub Models API, or OpenRouter API with messages."""
+def record_upstream_call():
+    """Count a query that needed an upstream completion."""
+    with fast_path_stats_lock:
+        FAST_PATH_STATS["upstream_calls"] += 1
+
+def get_fast_path_stats() -> Dict[str, Any]:
+    """Return how much upstream traffic the instant replies avoided."""
+    with fast_path_stats_lock:
+        local_replies = dict(FAST_PATH_STATS["local_replies"])
+        upstream_calls = FAST_PATH_STATS["upstream_calls"]
+        local_seconds = FAST_PATH_STATS["local_seconds"]
+    
+    local_total = sum(local_replies.values())
+    total = local_total + upstream_calls
+    
+    return {
+        "local_replies": local_replies,
+        "local_total": local_total,
+        "upstream_calls": upstream_calls,
+        "avoided_ratio": local_total / total if total else 0.0,
+        "avg_local_ms": local_seconds / local_total * 1000 if local_total else 0.0
+    }
+
+# Generation limits per query class (admin-configurable, saved as "generation_policy")
+DEFAULT_GENERATION_POLICY = {
+    "greeting": {"max_tokens": 150, "temperature": 0.7, "stop": [], "model": ""},
+    "off_topic": {"max_tokens": 80, "temperature": 0.3, "stop": [], "model": ""},
+    "short": {"max_tokens": 400, "temperature": 0.7, "stop": [], "model": ""},
+    "follow_up": {"max_tokens": 600, "temperature": 0.7, "stop": [], "model": ""},
+    "detailed": {"max_tokens": 1000, "temperature": 0.7, "stop": [], "model": ""}
+}
+
+# The fixed limit every request used before the policy existed
+BASELINE_MAX_TOKENS = 1000
+
+DETAIL_KEYWORDS = [
+    'strategy', 'strategies', 'explain', 'compare', 'difference', 'breakdown',
+    'step by step', 'in detail', 'detailed', 'plan', 'why', 'how do i', 'how to'
+]
+
+# Per-class measurements, shared by every session in this process
+GENERATION_STATS = {}
+generation_stats_lock = threading.Lock()
+
+def classify_query(query: str, history: list) -> str:
+    """Classify a query from cheap local signals to pick its generation limits."""
+    text_lower = query.lower()
     
-    # Detect API type based on key format
+    if is_greeting_or_polite(query) and not is_trading_related(query):
+        return "greeting"
+    
+    # filter_response replaces these answers anyway, so keep them short
+    if not is_trading_related(query):
+        return "off_topic"
+    
+    if len(query.split()) >= 25 or any(keyword in text_lower for keyword in DETAIL_KEYWORDS):
+        return "detailed"
+    
+    # The UI appends the current question before generating, so count prior answers instead
+    if any(item["role"] == "assistant" for item in history):
+        return "follow_up"
+    
+    return "short"
+
+def get_generation_policy() -> Dict[str, Dict[str, Any]]:
+    """Return the generation policy, with saved overrides applied to the defaults."""
+    saved_policy = get_setting("generation_policy", {}) or {}
+    
+    policy = {}
+    for query_class, defaults in DEFAULT_GENERATION_POLICY.items():
+        policy[query_class] = dict(defaults)
+        policy[query_class].update(saved_policy.get(query_class, {}))
+    return policy
+
+def choose_generation_params(query: str, history: list) -> Dict[str, Any]:
+    """Pick max_tokens, temperature, stop sequences and model for a query."""
+    query_class = classify_query(query, history)
+    params = dict(get_generation_policy()[query_class])
+    params["query_class"] = query_class
+    return params
+
+def record_generation(query_class: str, max_tokens: int, latency: float, completion_tokens: int, truncated: bool = False):
+    """Record latency, token use and cut-off answers for a query class."""
+    with generation_stats_lock:
+        stats = GENERATION_STATS.setdefault(query_class, {
+            "requests": 0,
+            "total_latency": 0.0,
+            "completion_tokens": 0,
+            "max_tokens": 0,
+            "truncated": 0
+        })
+        stats["requests"] += 1
+        stats["total_latency"] += latency
+        stats["completion_tokens"] += completion_tokens
+        stats["max_tokens"] += max_tokens
+        stats["truncated"] += int(truncated)
+
+def get_generation_stats() -> list:
+    """Return per-class latency, token and truncation measurements for the admin panel."""
+    with generation_stats_lock:
+        snapshot = {key: dict(value) for key, value in GENERATION_STATS.items()}
+    
+    rows = []
+    for query_class, stats in sorted(snapshot.items()):
+        requests_count = stats["requests"]
+        rows.append({
+            "class": query_class,
+            "requests": requests_count,
+            "avg latency (s)": round(stats["total_latency"] / requests_count, 2),
+            "avg completion tokens": round(stats["completion_tokens"] / requests_count, 1),
+            "avg max_tokens": round(stats["max_tokens"] / requests_count),
+            # Answers that hit max_tokens were cut off: raise the cap if this climbs
+            "truncated": f"{stats['truncated'] / requests_count:.1%}"
+        })
+    return rows
+
+# Chat completion endpoints for each supported key format
+PROVIDERS = {
+    "github": {
+        "name": "GitHub Models",
+        "api_url": "https://models.inference.ai.azure.com/chat/completions",
+        "models_url": "https://models.inference.ai.azure.com/models",
+        "model": "gpt-4o-mini"
+    },
+    "deepinfra": {
+        "name": "DeepInfra",
+        "api_url": "https://api.deepinfra.com/v1/openai/chat/completions",
+        "models_url": "https://api.deepinfra.com/v1/openai/models",
+        "model": "meta-llama/Llama-4-Scout-17B-16E-Instruct"
+    },
+    "openrouter": {
+        "name": "OpenRouter",
+        "api_url": "https://openrouter.ai/api/v1/chat/completions",
+        "models_url": "https://openrouter.ai/api/v1/models",
+        "model": "deepseek/deepseek-coder"
+    }
+}
+
+# Upstream prompt-cache accounting, shared by every session in this process
+CACHE_STATS = {"requests": 0, "cache_hits": 0, "prompt_tokens": 0, "cached_tokens": 0}
+cache_stats_lock = threading.Lock()
+
+def detect_provider(api_key: str):
+    """Detect the API provider from the key format."""
     if api_key.startswith("github_pat_"):
-        # GitHub Models API (free with GitHub token)
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": "gpt-4o-mini",
-            "messages": messages,
-            "max_tokens": 1000,
-            "temperature": 0.7
+        return "github"
+    if api_key.startswith("sk-or-"):
+        return "openrouter"
+    if api_key.startswith("sk-"):
+        return "deepinfra"
+    return None
+
+def supports_cache_control(provider: str, model: str) -> bool:
+    """Check if the model needs explicit cache_control breakpoints to cache the prompt."""
+    # DeepSeek, OpenAI and Llama hosts cache byte-identical prefixes automatically
+    return provider == "openrouter" and model.startswith(("anthropic/", "google/gemini"))
+
+def build_messages(query: str, system_prompt: str, history: list, knowledge_base: str = "") -> list:
+    """Build the chat messages with a byte-stable prefix that upstream caches can reuse."""
+    # Static content goes first and never changes between requests
+    prefix = system_prompt.strip()
+    if knowledge_base and knowledge_base.strip():
+        prefix += "\n\n## Knowledge Base\n\n" + knowledge_base.strip()
+    
+    messages = [{"role": "system", "content": prefix}]
+    
+    # Recent history follows the prefix. It's a sliding window, so only the system
+    # message above is guaranteed byte-stable between requests
+    for item in history:
+        messages.append({"role": item["role"], "content": item["content"]})
+    
+    messages.append({"role": "user", "content": query})
+    return messages
+
+def apply_cache_hints(messages: list, provider: str, model: str) -> list:
+    """Mark the static system prefix as cacheable for providers that need explicit hints."""
+    if not supports_cache_control(provider, model):
+        return messages
+    
+    hinted = list(messages)
+    if hinted and hinted[0]["role"] == "system" and isinstance(hinted[0]["content"], str):
+        hinted[0] = {
+            "role": "system",
+            "content": [{
+                "type": "text",
+                "text": hinted[0]["content"],
+                "cache_control": {"type": "ephemeral"}
+            }]
         }
-        
-        # GitHub Models API endpoint
-        api_url = "https://models.inference.ai.azure.com/chat/completions"
-        
-        try:
-            response = requests.post(
-                api_url,
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            # If GitHub Models fails, use Hugging Face free API
-            return call_github_llama_fallback(messages, api_key)
+    return hinted
+
+def extract_usage(response: Dict[Any, Any]) -> Dict[str, int]:
+    """Extract prompt, completion and cached token counts from an API response."""
+    usage = response.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    
+    # DeepSeek reports prompt_cache_hit_tokens, OpenAI-style APIs use prompt_tokens_details
+    cached_tokens = (
+        usage.get("prompt_cache_hit_tokens")
+        or details.get("cached_tokens")
+        or usage.get("cache_read_input_tokens")
+        or 0
+    )
     
-    elif api_key.startswith("sk-") and not api_key.startswith("sk-or-"):
-        # DeepInfra API for Llama 4 Scout (free)
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": "meta-llama/Llama-4-Scout-17B-16E-Instruct",
-            "messages": messages,
-            "max_tokens": 1000,
-            "temperature": 0.7,
-            "stream": False
+    return {
+        "prompt_tokens": usage.get("prompt_tokens") or 0,
+        "completion_tokens": usage.get("completion_tokens") or 0,
+        "cached_tokens": cached_tokens
+    }
+
+def is_truncated(response: Dict[Any, Any]) -> bool:
+    """Return True if the answer stopped because it reached max_tokens."""
+    try:
+        return response["choices"][0].get("finish_reason") == "length"
+    except (KeyError, IndexError, AttributeError):
+        return False
+
+def record_cache_usage(usage: Dict[str, int]):
+    """Add a response's token usage to the prompt-cache statistics."""
+    with cache_stats_lock:
+        CACHE_STATS["requests"] += 1
+        CACHE_STATS["prompt_tokens"] += usage["prompt_tokens"]
+        CACHE_STATS["cached_tokens"] += usage["cached_tokens"]
+        if usage["cached_tokens"]:
+            CACHE_STATS["cache_hits"] += 1
+    
+    record_metric("prompt_tokens", usage["prompt_tokens"])
+    record_metric("cached_prompt_tokens", usage["cached_tokens"])
+
+def get_cache_stats() -> Dict[str, Any]:
+    """Return prompt-cache statistics with hit ratios."""
+    with cache_stats_lock:
+        stats = dict(CACHE_STATS)
+    
+    stats["request_hit_ratio"] = stats["cache_hits"] / stats["requests"] if stats["requests"] else 0.0
+    stats["token_hit_ratio"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+    return stats
+
+# Rolling provider health, fed by the background prober (keyed by provider) and by
+# real traffic (keyed by "provider:model")
+HEALTH_WINDOW = 20
+PROVIDER_HEALTH = {}
+provider_health_lock = threading.Lock()
+
+# Keep-alive HTTP sessions per provider so requests reuse warm TLS connections
+HTTP_SESSIONS = {}
+http_sessions_lock = threading.Lock()
+
+health_prober_thread = None
+health_prober_lock = threading.Lock()
+
+def get_http_session(provider: str) -> requests.Session:
+    """Return the shared keep-alive HTTP session for a provider."""
+    with http_sessions_lock:
+        if provider not in HTTP_SESSIONS:
+            HTTP_SESSIONS[provider] = requests.Session()
+        return HTTP_SESSIONS[provider]
+
+def record_provider_result(provider: str, ok: bool, latency: float, error: str = ""):
+    """Add a request outcome to a provider's rolling latency and error-rate estimates."""
+    with provider_health_lock:
+        health = PROVIDER_HEALTH.setdefault(provider, {
+            "samples": deque(maxlen=HEALTH_WINDOW),
+            "latency_ewma": None,
+            "last_checked": None,
+            "last_failure": None,
+            "last_error": ""
+        })
+        health["samples"].append(ok)
+        health["last_checked"] = time.time()
+        if ok:
+            # Exponentially weighted, so a slow spell shows up within a few samples
+            if health["latency_ewma"] is None:
+                health["latency_ewma"] = latency
+            else:
+                health["latency_ewma"] = 0.7 * health["latency_ewma"] + 0.3 * latency
+        else:
+            health["last_failure"] = time.time()
+            health["last_error"] = error
+
+def get_provider_health() -> Dict[str, Dict[str, Any]]:
+    """Return the current health state of every provider seen so far."""
+    with provider_health_lock:
+        snapshot = {
+            provider: dict(health, samples=list(health["samples"]))
+            for provider, health in PROVIDER_HEALTH.items()
         }
+    
+    result = {}
+    for provider, health in snapshot.items():
+        samples = health["samples"]
+        error_rate = samples.count(False) / len(samples) if samples else 0.0
+        latency = health["latency_ewma"]
         
-        # DeepInfra API endpoint
-        api_url = "https://api.deepinfra.com/v1/openai/chat/completions"
-        
-        try:
-            response = requests.post(
-                api_url,
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            return {"error": f"DeepInfra API Error: {str(e)}"}
-        
-    elif api_key.startswith("sk-or-"):
-        # OpenRouter API (fallback)
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+        if not samples:
+            status = "unknown"
+        # Judge "down" on the latest samples only, so one good probe brings a provider back
+        elif not any(samples[-3:]):
+            status = "down"
+        elif error_rate > 0.1 or (latency is not None and latency > 5.0):
+            status = "degraded"
+        else:
+            status = "healthy"
         
-        data = {
-            "model": "deepseek/deepseek-coder",
-            "messages": messages,
-            "max_tokens": 1000,
-            "temperature": 0.7
+        result[provider] = {
+            "status": status,
+            "latency_ewma": latency,
+            "error_rate": error_rate,
+            "samples": len(samples),
+            "last_checked": health["last_checked"],
+            "last_failure": health["last_failure"],
+            "last_error": health["last_error"]
         }
+    return result
+
+def is_provider_down(provider: str, model: str) -> bool:
+    """Return True if the provider's probes or recent calls to this model say it's down.
+    
+    A "down" state is trusted for a minute after the last failure, or for one
+    probe interval if that's longer; after that the next request tries again.
+    """
+    health = get_provider_health()
+    retry_after = max(60, get_setting("health_probe_interval", 60) or 0)
+    for key in (provider, f"{provider}:{model}"):
+        state = health.get(key)
+        if state and state["status"] == "down" and time.time() - state["last_failure"] < retry_after:
+            return True
+    return False
+
+def is_provider_degraded(provider: str, model: str) -> bool:
+    """Return True if the provider's probes or recent calls to this model look unhealthy."""
+    health = get_provider_health()
+    return any(health.get(key, {}).get("status") in ("degraded", "down") for key in (provider, f"{provider}:{model}"))
+
+def probe_provider(provider: str, api_key: str) -> bool:
+    """Send a minimal request to a provider and record the outcome."""
+    config = PROVIDERS[provider]
+    start_time = time.perf_counter()
+    try:
+        # Listing models is free and warms the same host as chat completions
+        response = get_http_session(provider).get(
+            config["models_url"],
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=10
+        )
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        record_provider_result(provider, False, time.perf_counter() - start_time, str(e))
+        return False
+    
+    record_provider_result(provider, True, time.perf_counter() - start_time)
+    return True
+
+def run_health_prober():
+    """Probe the configured provider forever, at the configured interval."""
+    while True:
+        interval = get_setting("health_probe_interval", 60)
+        api_key = load_config().get("api_key", "")
+        provider = detect_provider(api_key) if api_key else None
         
-        # OpenRouter API endpoint
-        api_url = "https://openrouter.ai/api/v1/chat/completions"
+        if interval and provider:
+            try:
+                probe_provider(provider, api_key)
+            except Exception:
+                # Never let a bad probe kill the prober
+                pass
         
-        try:
-            response = requests.post(
-                api_url,
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            return {"error": f"OpenRouter API Error: {str(e)}"}
+        time.sleep(interval or 60)
+
+def start_health_prober():
+    """Start the background health prober once per process."""
+    global health_prober_thread
+    with health_prober_lock:
+        if health_prober_thread is None or not health_prober_thread.is_alive():
+            health_prober_thread = threading.Thread(target=run_health_prober, name="provider-health-prober", daemon=True)
+            health_prober_thread.start()
+
+# Model tiers per provider; prices are USD per 1M tokens (adjust to your plan)
+DEFAULT_MODEL_TIERS = {
+    "github": {
+        "small": {"model": "Meta-Llama-3.1-8B-Instruct", "input_price": 0.0, "output_price": 0.0},
+        "large": {"model": "gpt-4o-mini", "input_price": 0.0, "output_price": 0.0}
+    },
+    "deepinfra": {
+        "small": {"model": "meta-llama/Meta-Llama-3.1-8B-Instruct", "input_price": 0.03, "output_price": 0.05},
+        "large": {"model": "meta-llama/Llama-4-Scout-17B-16E-Instruct", "input_price": 0.08, "output_price": 0.30}
+    },
+    "openrouter": {
+        "small": {"model": "meta-llama/llama-3.1-8b-instruct", "input_price": 0.02, "output_price": 0.03},
+        "large": {"model": "deepseek/deepseek-coder", "input_price": 0.14, "output_price": 0.28}
+    }
+}
+
+# Phrases that suggest the small model wasn't confident enough to answer
+LOW_CONFIDENCE_PHRASES = [
+    "i'm not sure", "i am not sure", "i don't know", "i do not know",
+    "i cannot answer", "i can't answer", "unable to answer", "as an ai"
+]
+
+# Per-tier latency and cost, shared by every session in this process
+TIER_STATS = {}
+tier_stats_lock = threading.Lock()
+
+def get_model_tiers() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Return the model tiers, with saved overrides applied to the defaults."""
+    saved_tiers = get_setting("model_tiers", {}) or {}
+    
+    tiers = {}
+    for provider, provider_tiers in DEFAULT_MODEL_TIERS.items():
+        tiers[provider] = {}
+        for tier, defaults in provider_tiers.items():
+            tiers[provider][tier] = dict(defaults)
+            tiers[provider][tier].update(saved_tiers.get(provider, {}).get(tier, {}))
+    return tiers
+
+def estimate_query_complexity(query: str) -> float:
+    """Estimate from 0 to 1 how much reasoning a query needs, from cheap local signals."""
+    text_lower = query.lower()
+    
+    score = min(len(query.split()) / 40, 0.4)
+    if any(keyword in text_lower for keyword in DETAIL_KEYWORDS):
+        score += 0.3
+    if query.count("?") > 1:
+        score += 0.15
+    if any(char.isdigit() for char in query):
+        # Numbers usually mean a calculation (position size, risk, leverage)
+        score += 0.15
+    if " vs " in text_lower or " versus " in text_lower or " and " in text_lower:
+        score += 0.1
+    return min(score, 1.0)
+
+def passes_confidence_check(result: Dict[Any, Any], query: str) -> bool:
+    """Check if a small-model answer is good enough to return without escalating."""
+    try:
+        answer = result["choices"][0]["message"]["content"] or ""
+    except (KeyError, IndexError, TypeError):
+        return False
+    
+    if len(answer.strip()) < 20:
+        return False
     
+    answer_lower = answer.lower()
+    if any(phrase in answer_lower for phrase in LOW_CONFIDENCE_PHRASES):
+        return False
+    
+    # The answer drifted off-topic and filter_response would replace it
+    return filter_response_verdict(answer, query)[1] != "replaced_off_topic"
+
+def record_tier_call(provider: str, tier: str, tier_config: Dict[str, Any], latency: float, result: Dict[Any, Any], escalated: bool):
+    """Record latency, tokens and cost for a call on one tier."""
+    usage = extract_usage(result) if "error" not in result else {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    cost = (
+        usage["prompt_tokens"] * tier_config.get("input_price", 0.0)
+        + usage["completion_tokens"] * tier_config.get("output_price", 0.0)
+    ) / 1_000_000
+    
+    with tier_stats_lock:
+        stats = TIER_STATS.setdefault(f"{provider}:{tier}", {
+            "requests": 0,
+            "errors": 0,
+            "escalated": 0,
+            "total_latency": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cost": 0.0
+        })
+        stats["requests"] += 1
+        stats["errors"] += 1 if "error" in result else 0
+        stats["escalated"] += 1 if escalated else 0
+        stats["total_latency"] += latency
+        stats["prompt_tokens"] += usage["prompt_tokens"]
+        stats["completion_tokens"] += usage["completion_tokens"]
+        stats["cost"] += cost
+
+def get_tier_stats() -> list:
+    """Return per-tier latency and cost measurements for the admin panel."""
+    with tier_stats_lock:
+        snapshot = {key: dict(value) for key, value in TIER_STATS.items()}
+    
+    return [
+        {
+            "tier": key,
+            "requests": stats["requests"],
+            "escalated to large": stats["escalated"],
+            "errors": stats["errors"],
+            "avg latency (s)": round(stats["total_latency"] / stats["requests"], 2),
+            "tokens in/out": f"{stats['prompt_tokens']} / {stats['completion_tokens']}",
+            "cost (USD)": round(stats["cost"], 6)
+        }
+        for key, stats in sorted(snapshot.items())
+    ]
+
+def call_ai_api(messages: list, api_key: str, model: str = None, params: Dict[str, Any] = None) -> Dict[Any, Any]:
+    """Route a request to the small or large model tier, escalating when the small one falls short."""
+    params = params or {}
+    provider = detect_provider(api_key)
+    
+    # An explicit model (or routing switched off) bypasses the tiers
+    if provider is None or model or params.get("model") or not get_setting("tiered_routing", True):
+        return call_provider_api(messages, api_key, model, params)
+    
+    query = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), "")
+    complexity = estimate_query_complexity(query)
+    tiers = get_model_tiers()[provider]
+    tier = "large" if complexity >= get_setting("tier_complexity_threshold", 0.4) else "small"
+    
+    # A struggling small tier would likely cost a second call anyway, so go straight to large
+    if tier == "small" and not params.get("diagnostic") and is_provider_degraded(provider, tiers["small"]["model"]):
+        tier = "large"
+    
+    start_time = time.perf_counter()
+    result = call_provider_api(messages, api_key, tiers[tier]["model"], params, fallback=False)
+    
+    escalated = False
+    if (tier == "small" and not result.get("rate_limited")
+            and ("error" in result or not passes_confidence_check(result, query))):
+        record_tier_call(provider, tier, tiers[tier], time.perf_counter() - start_time, result, True)
+        escalated = True
+        small_result = result
+        tier = "large"
+        start_time = time.perf_counter()
+        result = call_provider_api(messages, api_key, tiers[tier]["model"], params, fallback=False)
+        record_tier_call(provider, tier, tiers[tier], time.perf_counter() - start_time, result, False)
+        
+        # A low-confidence small answer still beats an error when the large tier fails
+        if "error" in result and "error" not in small_result:
+            result = small_result
+            tier = "small"
     else:
+        record_tier_call(provider, tier, tiers[tier], time.perf_counter() - start_time, result, False)
+    
+    # The local template is the last resort for GitHub keys, once every tier has failed
+    if provider == "github" and "error" in result and not result.get("rate_limited"):
+        result = call_github_llama_fallback(messages, api_key)
+    result["routing"] = {
+        "tier": tier,
+        "model": tiers[tier]["model"],
+        "complexity": round(complexity, 2),
+        "escalated": escalated
+    }
+    return result
+
+def call_provider_api(messages: list, api_key: str, model: str = None, params: Dict[str, Any] = None,
+                      fallback: bool = True) -> Dict[Any, Any]:
+    """Call DeepInfra API, GitHub Models API, or OpenRouter API with messages.
+    
+    With fallback=False a failing GitHub Models call returns an error
+    instead of the local template answer, so the tier router can escalate.
+    """
+    
+    # Detect API type based on key format
+    provider = detect_provider(api_key)
+    if provider is None:
         return {"error": "Invalid API key format. Please use a DeepInfra API key (sk-...) or OpenRouter key (sk-or-...)"}
+    
+    config = PROVIDERS[provider]
+    params = params or {}
+    model = model or params.get("model") or config["model"]
+    
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    
+    if get_setting("prompt_cache_mode", True):
+        messages = apply_cache_hints(messages, provider, model)
+    
+    data = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": params.get("max_tokens", BASELINE_MAX_TOKENS),
+        "temperature": params.get("temperature", 0.7)
+    }
+    
+    if params.get("stop"):
+        data["stop"] = params["stop"]
+    
+    if provider == "deepinfra":
+        data["stream"] = False
+    elif provider == "openrouter":
+        # Ask OpenRouter to include cached token counts in the usage block
+        data["usage"] = {"include": True}
+    
+    # Health is tracked per model, so one failing tier doesn't block the others
+    health_key = f"{provider}:{model}"
+    
+    # Fail fast instead of sending users to an upstream the prober or recent calls saw down.
+    # Diagnostic calls still go through, so the admin can check it's back
+    if not params.get("diagnostic") and is_provider_down(provider, model):
+        if provider == "github" and fallback:
+            return call_github_llama_fallback(messages, api_key)
+        return {"error": f"{config['name']} API Error: {model} is down"}
+    
+    # Host-wide rate limit, taken per upstream call so escalations and retries count too
+    if not params.get("diagnostic") and not take_upstream_token(provider, background=params.get("background", False)):
+        record_metric("rate_limited")
+        return {"error": "Too many requests right now. Please try again in a moment.", "rate_limited": True}
+    
+    start_time = time.perf_counter()
+    try:
+        response = get_http_session(provider).post(
+            config["api_url"],
+            headers=headers,
+            json=data,
+            timeout=30
+        )
+        response.raise_for_status()
+        result = response.json()
+    except requests.exceptions.RequestException as e:
+        record_provider_result(health_key, False, time.perf_counter() - start_time, str(e))
+        if provider == "github" and fallback:
+            # If GitHub Models fails, use Hugging Face free API
+            return call_github_llama_fallback(messages, api_key)
+        return {"error": f"{config['name']} API Error: {str(e)}"}
+    
+    record_provider_result(health_key, True, time.perf_counter() - start_time)
+    
+    if "usage" in result:
+        record_cache_usage(extract_usage(result))
+    
+    return result
 
 def call_github_llama_fallback(messages: list, api_key: str) -> Dict[Any, Any]:
     """Fallback to free Hugging Face models for GitHub PAT tokens."""
@@ -818,7 +2783,9 @@ def call_github_llama_fallback(messages: list, api_key: str) -> Dict[Any, Any]:
                 "message": {
                     "content": response_text
                 }
-            }]
+            }],
+            # Marks a template answer, so it isn't cached or stored as an FAQ answer
+            "fallback": True
         }
         
     except Exception as e:
@@ -854,64 +2821,491 @@ Based on current market conditions, here's my professional insight:
     import random
     return random.choice(responses)
 
-def process_query(query: str, system_prompt: str, api_key: str) -> str:
+# Precomputed answers for frequent questions, stored in the shared store and keyed
+# on the normalized question and a hash of the system prompt and knowledge base
+FAQ_STATS = {"served": 0, "refreshes": 0, "warmed": 0, "failed": 0}
+faq_stats_lock = threading.Lock()
+faq_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="faq-warmup")
+faq_refreshing = set()
+faq_startup_warmup_started = False
+
+def get_prompt_version(system_prompt: str) -> str:
+    """Hash the static prompt prefix, so answers are regenerated when it changes."""
+    prefix = system_prompt + "\n" + (get_setting("knowledge_base", "") or "")
+    return hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+
+def faq_key(query: str, system_prompt: str) -> str:
+    """Build the FAQ store key for a question under the current prompt."""
+    return f"faq:{get_prompt_version(system_prompt)}:{normalize_query(query)}"
+
+def get_faq_questions() -> list:
+    """Return the curated FAQ questions, one per line in the config."""
+    return [line.strip() for line in (get_setting("faq_questions", "") or "").splitlines() if line.strip()]
+
+def lookup_faq_answer(query: str, system_prompt: str, api_key: str):
+    """Return a precomputed answer for the question, refreshing it in the background once stale."""
+    key = faq_key(query, system_prompt)
+    try:
+        entry = get_shared_store().get(key)
+    except sqlite3.Error:
+        return None
+    if entry is None:
+        return None
+    
+    # Serve the stale answer now and regenerate it for the next user
+    if time.time() - entry["generated_at"] > get_setting("faq_ttl", 24 * 3600):
+        with faq_stats_lock:
+            refresh = key not in faq_refreshing
+            faq_refreshing.add(key)
+        if refresh:
+            faq_executor.submit(refresh_faq_answer, query, system_prompt, api_key, key)
+    
+    with faq_stats_lock:
+        FAQ_STATS["served"] += 1
+    return entry["response"]
+
+def generate_faq_answer(query: str, system_prompt: str, api_key: str) -> bool:
+    """Generate and store the answer to one FAQ question, waiting out rate limits."""
+    turn = {"source": "", "provider": "", "model": "", "verdict": ""}
+    for _ in range(30):
+        response = generate_response(query, system_prompt, api_key, turn, use_faq=False, history=[], background=True)
+        if turn["source"] != "rate_limited":
+            break
+        time.sleep(2)
+    
+    # Only keep real model answers, not errors, template fallbacks or local replies
+    if turn["source"] not in ("upstream", "response_cache") or response.startswith("Error:"):
+        with faq_stats_lock:
+            FAQ_STATS["failed"] += 1
+        return False
+    
+    try:
+        # Entries outlive their refresh TTL so stale answers can still be served, but
+        # answers for old prompt versions eventually expire
+        get_shared_store().set(
+            faq_key(query, system_prompt),
+            {"response": response, "generated_at": time.time()},
+            ttl=4 * get_setting("faq_ttl", 24 * 3600)
+        )
+    except sqlite3.Error:
+        return False
+    
+    with faq_stats_lock:
+        FAQ_STATS["warmed"] += 1
+    return True
+
+def refresh_faq_answer(query: str, system_prompt: str, api_key: str, key: str):
+    """Regenerate a stale FAQ answer in the background."""
+    try:
+        if generate_faq_answer(query, system_prompt, api_key):
+            with faq_stats_lock:
+                FAQ_STATS["refreshes"] += 1
+    finally:
+        with faq_stats_lock:
+            faq_refreshing.discard(key)
+
+def warm_up_faq(questions: list, system_prompt: str, api_key: str, max_workers: int = 4) -> Dict[str, int]:
+    """Generate answers for FAQ questions in parallel, skipping ones already fresh for this prompt."""
+    ttl = get_setting("faq_ttl", 24 * 3600)
+    pending = []
+    for question in dict.fromkeys(questions):
+        # Greetings and off-topic questions are already answered locally
+        if match_fast_path(question) is not None:
+            continue
+        try:
+            entry = get_shared_store().get(faq_key(question, system_prompt))
+        except sqlite3.Error:
+            entry = None
+        if entry is None or time.time() - entry["generated_at"] > ttl:
+            pending.append(question)
+    
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="faq-warmup") as executor:
+        results = list(executor.map(lambda question: generate_faq_answer(question, system_prompt, api_key), pending))
+    
+    return {
+        "questions": len(questions),
+        "skipped": len(questions) - len(pending),
+        "generated": results.count(True),
+        "failed": results.count(False)
+    }
+
+def start_faq_warmup(system_prompt: str, api_key: str):
+    """Warm up the FAQ answers in the background."""
+    questions = get_faq_questions()
+    if questions and api_key and get_setting("faq_enabled", True):
+        faq_executor.submit(warm_up_faq, questions, system_prompt, api_key)
+
+def start_faq_warmup_on_startup():
+    """Warm up the FAQ once per process, so a deploy never leaves popular questions cold."""
+    global faq_startup_warmup_started
+    with faq_stats_lock:
+        if faq_startup_warmup_started:
+            return
+        faq_startup_warmup_started = True
+    
+    saved_config = load_config()
+    start_faq_warmup(saved_config.get("system_prompt", DEFAULT_SYSTEM_PROMPT), saved_config.get("api_key", ""))
+
+def get_faq_stats() -> Dict[str, int]:
+    """Return FAQ serve, warm-up and refresh counts."""
+    with faq_stats_lock:
+        stats = dict(FAQ_STATS)
+        stats["refreshing"] = len(faq_refreshing)
+    return stats
+
+# Detached generation jobs. Answers are generated off the script thread and kept by
+# session and message id, so a rerun or reconnecting client picks up the same answer
+# instead of paying for a new one.
+JOBS = {}
+jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("XENON_JOB_WORKERS", "8")), thread_name_prefix="generation-job")
+JOB_RETENTION_SECONDS = 3600
+
+def run_generation_job(session_id: str, message_id: str, query: str, system_prompt: str, api_key: str, history: list,
+                       settings: Dict[str, Any]):
+    """Generate one answer in the background, with the submitting session's settings, and publish the result."""
+    try:
+        with use_settings(settings), timed_phase("generation_job"):
+            response = process_query(query, system_prompt, api_key, history=history, session_id=session_id)
+        status = "done"
+    except Exception as e:
+        response = f"Error: {str(e)}"
+        status = "failed"
+    
+    with jobs_lock:
+        job = JOBS[(session_id, message_id)]
+        job.update(status=status, response=response, finished=time.time())
+    job["done"].set()
+    
+    # Other workers can hand the answer to a client that reconnects through them
+    try:
+        get_shared_store().set(
+            f"job:{session_id}:{message_id}",
+            {"status": status, "response": response},
+            ttl=JOB_RETENTION_SECONDS
+        )
+    except sqlite3.Error:
+        pass
+
+def submit_generation_job(session_id: str, message_id: str, query: str, system_prompt: str, api_key: str, history: list,
+                          settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Start generating an answer unless a job for this message already exists."""
+    now = time.time()
+    with jobs_lock:
+        # Forget finished jobs nobody came back for
+        for key in [key for key, job in JOBS.items() if job.get("finished") and now - job["finished"] > JOB_RETENTION_SECONDS]:
+            del JOBS[key]
+        
+        job = JOBS.get((session_id, message_id))
+        if job is not None:
+            return dict(job)
+        
+        job = {"status": "running", "response": None, "started": now, "finished": None, "done": threading.Event()}
+        JOBS[(session_id, message_id)] = job
+    
+    # Tell other workers it's in progress; the marker expires if this worker dies
+    try:
+        get_shared_store().set(f"job:{session_id}:{message_id}", {"status": "running", "response": None}, ttl=120)
+    except sqlite3.Error:
+        pass
+    
+    job_executor.submit(run_generation_job, session_id, message_id, query, system_prompt, api_key, list(history), settings)
+    return dict(job)
+
+def get_generation_job(session_id: str, message_id: str):
+    """Return the job for a message from this process or, once finished, from any worker."""
+    with jobs_lock:
+        job = JOBS.get((session_id, message_id))
+        if job is not None:
+            return dict(job)
+    
+    try:
+        return get_shared_store().get(f"job:{session_id}:{message_id}")
+    except sqlite3.Error:
+        return None
+
+def wait_for_generation_job(session_id: str, message_id: str, job: Dict[str, Any], timeout: float):
+    """Wait up to timeout for a running job, returning as soon as it finishes."""
+    if job is None or job["status"] != "running":
+        return job
+    
+    if job.get("done") is not None:
+        job["done"].wait(timeout)
+        return get_generation_job(session_id, message_id)
+    
+    # Running on another worker: only the shared store can say when it's done
+    deadline = time.monotonic() + timeout
+    while job is not None and job["status"] == "running" and time.monotonic() < deadline:
+        time.sleep(0.2)
+        job = get_generation_job(session_id, message_id)
+    return job
+
+def get_job_stats() -> Dict[str, int]:
+    """Return counts of running and finished jobs in this process."""
+    with jobs_lock:
+        statuses = [job["status"] for job in JOBS.values()]
+    return {status: statuses.count(status) for status in ("running", "done", "failed")}
+
+def save_conversation(session_id: str, history: list, pending_message_id: str = None):
+    """Keep a client's conversation in the shared store so a reconnect can resume it."""
+    try:
+        get_shared_store().set(
+            f"conversation:{session_id}",
+            {"history": history, "pending": pending_message_id},
+            ttl=24 * 3600
+        )
+    except sqlite3.Error:
+        pass
+
+RESUME_COOKIE = "xenon_resume"
+PROCESS_RESUME_SECRET = secrets.token_hex(32)
+
+def get_resume_secret() -> bytes:
+    """Return the key that signs resume tokens, shared by all workers."""
+    secret = os.environ.get("XENON_RESUME_SECRET")
+    if secret:
+        return secret.encode()
+    
+    store = get_shared_store()
+    try:
+        secret = store.get("resume_secret")
+        if secret is None:
+            store.set("resume_secret", secrets.token_hex(32))
+            secret = store.get("resume_secret")
+    except sqlite3.Error:
+        secret = None
+    # Without the shared store, sign with a per-process key so tokens still can't be forged
+    return (secret or PROCESS_RESUME_SECRET).encode()
+
+def make_resume_token(session_id: str) -> str:
+    """Sign a session id so the client can prove it owns the conversation."""
+    signature = hmac.new(get_resume_secret(), session_id.encode(), hashlib.sha256).hexdigest()
+    return f"{session_id}.{signature}"
+
+def verify_resume_token(token: str):
+    """Return the session id in a resume token, or None if the signature doesn't match."""
+    session_id, _, signature = (token or "").rpartition(".")
+    if not session_id or not hmac.compare_digest(make_resume_token(session_id), token):
+        return None
+    return session_id
+
+def set_resume_cookie(token: str):
+    """Store the resume token in a first-party cookie instead of the shareable page URL."""
+    components.html(f"""
+    <script>
+    const secure = window.parent.location.protocol === "https:";
+    const cookie = "{RESUME_COOKIE}={token}; path=/; max-age={24 * 3600}" +
+        (secure ? "; SameSite=None; Secure" : "; SameSite=Lax");
+    try {{ window.parent.document.cookie = cookie; }} catch (e) {{ document.cookie = cookie; }}
+    </script>
+    """, height=0)
+
+def resume_conversation():
+    """Tie the session to a signed client cookie and restore its conversation after a reconnect."""
+    # st.context.cookies holds the cookies sent with the websocket handshake
+    client_id = verify_resume_token(st.context.cookies.get(RESUME_COOKIE))
+    
+    if client_id and client_id != st.session_state.session_id:
+        # A new session for a known client: the websocket dropped or the page was reopened
+        st.session_state.session_id = client_id
+        try:
+            saved = get_shared_store().get(f"conversation:{client_id}")
+        except sqlite3.Error:
+            saved = None
+        if saved:
+            st.session_state.chat_history = saved["history"]
+            st.session_state.pending_message_id = saved["pending"]
+            st.session_state.is_typing = bool(saved["pending"])
+    
+    # Handshake cookies don't change during a session, so keep (re)setting until a reconnect sees it.
+    # The markup is identical on every run, so Streamlit doesn't reload the frame.
+    if client_id != st.session_state.session_id:
+        set_resume_cookie(make_resume_token(st.session_state.session_id))
+
+def process_query(query: str, system_prompt: str, api_key: str, use_fast_path: bool = True, history: list = None,
+                  session_id: str = None, diagnostic: bool = False) -> str:
     """Process user query and return AI response."""
+    turn = {"source": "", "provider": "", "model": "", "verdict": ""}
     
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": query}
-    ]
+    start_time = time.perf_counter()
+    response = generate_response(query, system_prompt, api_key, turn, use_fast_path, history=history, diagnostic=diagnostic)
+    latency = time.perf_counter() - start_time
     
-    # Add recent chat history for context
-    if st.session_state.chat_history:
-        # Add last 3 exchanges for context
-        recent_history = st.session_state.chat_history[-6:]  # Last 3 Q&A pairs
-        for item in recent_history:
-            messages.insert(-1, {"role": item["role"], "content": item["content"]})
+    # Connection tests aren't conversations
+    if diagnostic:
+        return response
     
-    response = call_ai_api(messages, api_key)
+    log_conversation_turn({
+        "timestamp": datetime.now().isoformat(timespec="milliseconds"),
+        "session_id": session_id if session_id is not None else get_setting("session_id", ""),
+        "query": query,
+        "normalized_query": normalize_query(query),
+        "response": response,
+        "source": turn["source"],
+        "provider": turn["provider"],
+        "model": turn["model"],
+        "latency_ms": round(latency * 1000, 1),
+        "prompt_tokens": turn.get("prompt_tokens", 0),
+        "completion_tokens": turn.get("completion_tokens", 0),
+        "cached_tokens": turn.get("cached_tokens", 0),
+        "verdict": turn["verdict"]
+    })
     
+    return response
+
+def generate_response(query: str, system_prompt: str, api_key: str, turn: Dict[str, Any], use_fast_path: bool = True,
+                      use_faq: bool = True, history: list = None, diagnostic: bool = False,
+                      background: bool = False) -> str:
+    """Run the response pipeline, describing how the answer was produced in `turn`.
+    
+    Diagnostic requests always reach the provider: they skip the FAQ, the
+    response cache, the rate limiter and health-based routing. Background
+    requests draw on the smaller background share of the rate limit.
+    """
+    
+    # Answer greetings and off-topic questions without a paid completion
+    if use_fast_path and get_setting("fast_path_enabled", True):
+        with timed_phase("fast_path"):
+            local_response = fast_path_response(query)
+        if local_response is not None:
+            record_metric("local_replies")
+            turn["source"] = "fast_path"
+            turn["verdict"] = match_fast_path(query)
+            return local_response
+    
+    # Popular questions are answered ahead of time by the FAQ warm-up
+    if use_faq and not diagnostic and get_setting("faq_enabled", True):
+        with timed_phase("faq_lookup"):
+            faq_response = lookup_faq_answer(query, system_prompt, api_key)
+        if faq_response is not None:
+            record_metric("faq_replies")
+            turn["source"] = "faq"
+            return faq_response
+    
+    # Add last 3 exchanges for context
+    if history is None:
+        history = st.session_state.chat_history
+    # The UI appends the question before generating; build_messages adds it once itself
+    if history and history[-1]["role"] == "user" and history[-1]["content"] == query:
+        history = history[:-1]
+    recent_history = history[-6:]  # Last 3 Q&A pairs
+    
+    with timed_phase("build_messages"):
+        messages = build_messages(
+            query,
+            system_prompt,
+            recent_history,
+            get_setting("knowledge_base", "")
+        )
+        
+        # Size the generation to the query instead of a fixed limit
+        params = choose_generation_params(query, recent_history)
+        params["diagnostic"] = diagnostic
+        params["background"] = background
+    
+    # Reuse an answer any worker generated for the same conversation
+    provider = detect_provider(api_key)
+    turn["provider"] = provider or ""
+    turn["model"] = params.get("model") or (PROVIDERS[provider]["model"] if provider else "")
+    cache_key = response_cache_key(messages, f"{provider}:{params.get('model', '')}")
+    with timed_phase("response_cache"):
+        cached_response = None if diagnostic else get_cached_response(cache_key)
+    if cached_response is not None:
+        record_metric("response_cache_hits")
+        turn["source"] = "response_cache"
+        return cached_response
+    
+    record_upstream_call()
+    record_metric("upstream_calls")
+    start_time = time.perf_counter()
+    with timed_phase("call_ai_api"):
+        response = call_ai_api(messages, api_key, params=params)
+    latency = time.perf_counter() - start_time
+    
+    if response.get("rate_limited"):
+        turn["source"] = "rate_limited"
+    elif response.get("fallback"):
+        turn["source"] = "fallback"
+    else:
+        turn["source"] = "upstream"
+    if "routing" in response:
+        turn["model"] = response["routing"]["model"]
     if "error" in response:
+        turn["verdict"] = "error"
         return f"Error: {response['error']}"
     
+    usage = extract_usage(response)
+    turn.update(usage)
+    record_generation(
+        params["query_class"],
+        params["max_tokens"],
+        latency,
+        usage["completion_tokens"],
+        truncated=is_truncated(response)
+    )
+    
     try:
         raw_response = response["choices"][0]["message"]["content"]
         # Filter the response to ensure it's trading-focused
-        filtered_response = filter_response(raw_response, query)
+        with timed_phase("filter_response"):
+            filtered_response, turn["verdict"] = filter_response_verdict(raw_response, query)
+        if not diagnostic and turn["source"] == "upstream":
+            store_cached_response(cache_key, filtered_response)
         return filtered_response
     except (KeyError, IndexError):
+        turn["verdict"] = "error"
         return "Error: Unexpected response format from AI API"
 
 def main():
     """Main application function."""
-    st.set_page_config(
-        page_title="Xenon Trader Live Assistant",
-        page_icon="📈",
-        layout="wide"
-    )
-    
-    init_session_state()
-    
-    # URL parameter to access admin panel
-    query_params = st.query_params
-    
-    # Hide sidebar for non-admin users
-    if "admin" not in query_params:
-        st.markdown("""
-        <style>
-        .css-1d391kg {display: none;}
-        .css-1rs6os {display: none;}
-        .css-17eq0hr {display: none;}
-        </style>
-        """, unsafe_allow_html=True)
-    
-    if "admin" in query_params:
-        admin_panel()
-    else:
-        user_interface()
+    with profiled_run(), timed_phase("main"):
+        with timed_phase("page_config"):
+            st.set_page_config(
+                page_title="Xenon Trader Live Assistant",
+                page_icon="📈",
+                layout="wide"
+            )
+        
+        with timed_phase("init_session_state"):
+            init_session_state()
+            start_health_prober()
+            start_faq_warmup_on_startup()
+        
+        # URL parameter to access admin panel
+        query_params = st.query_params
+        
+        # Hide sidebar for non-admin users
+        if "admin" not in query_params:
+            st.markdown("""
+            <style>
+            .css-1d391kg {display: none;}
+            .css-1rs6os {display: none;}
+            .css-17eq0hr {display: none;}
+            </style>
+            """, unsafe_allow_html=True)
+        
+        if "admin" in query_params:
+            with timed_phase("admin_panel"):
+                admin_panel()
+        else:
+            with timed_phase("user_interface"):
+                user_interface()
     
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "warmup-faq":
+        # python openrouter_agent.py warmup-faq  (run after each deploy)
+        saved_config = load_config()
+        print(json.dumps(warm_up_faq(
+            get_faq_questions(),
+            saved_config.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
+            saved_config.get("api_key", "")
+        ), indent=2))
+    elif len(sys.argv) > 1 and sys.argv[1] == "summarize-logs":
+        # python openrouter_agent.py summarize-logs [log_dir]
+        log_dir = sys.argv[2] if len(sys.argv) > 2 else "logs/conversations"
+        print(json.dumps(summarize_conversation_logs(log_dir), indent=2))
+    else:
+        main()
 
 